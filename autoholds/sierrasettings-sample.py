@@ -26,6 +26,24 @@ class SierraApiSettings:
         self.base_url = kwargs['base_url']
         self.client_key = kwargs['client_key']
         self.client_secret = kwargs['client_secret']
+        # Seconds to wait for the Sierra API to connect or respond
+        self.timeout = kwargs.get('timeout', 60)
+        # How many times to retry a request that failed with a connection error, a timeout, 429 or 5xx
+        self.max_retries = kwargs.get('max_retries', 3)
+        # The retries back off exponentially, with jitter, waiting on average backoff_factor * 2^n / 2 seconds
+        # before retry n, but never more than max_backoff seconds
+        self.backoff_factor = kwargs.get('backoff_factor', 0.5)
+        self.max_backoff = kwargs.get('max_backoff', 60)
+        # If set, make no more than rate_limit requests per second (on average), in bursts of up to rate_limit_burst
+        self.rate_limit = kwargs.get('rate_limit', None)
+        self.rate_limit_burst = kwargs.get('rate_limit_burst', None)
+        # Keep up to pool_size connections to the Sierra API open between requests. With pool_block, never make more
+        # than pool_size connections at once, and wait for a free one instead.
+        self.pool_size = kwargs.get('pool_size', 10)
+        self.pool_block = kwargs.get('pool_block', False)
+        # Whether to keep connections open between requests at all, and to ask for compressed (gzip) responses
+        self.keep_alive = kwargs.get('keep_alive', True)
+        self.compress = kwargs.get('compress', True)
 
     def __str__(self):
         return str(self.base_url)
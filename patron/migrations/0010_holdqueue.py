@@ -0,0 +1,55 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-05-16 02:31
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patron', '0009_auto_20160316_2121'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HoldQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_hold_queue_order', models.IntegerField()),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patron.Author')),
+                ('format', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patron.Format')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patron.Language')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='holdqueue',
+            unique_together=set([('author', 'format', 'language')]),
+        ),
+        migrations.RunSQL(
+            'INSERT INTO patron_holdqueue (author_id, format_id, language_id, last_hold_queue_order) '
+            'SELECT author_id, format_id, language_id, MAX(hold_queue_order) '
+            'FROM patron_registration '
+            'GROUP BY author_id, format_id, language_id',
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patron', '0010_holdqueue'),
+    ]
+
+    #
+    # Registrations are looked up by hold queue, in hold queue order, to load the registration index, to find the
+    # last position in a queue and to find the registrations at the front of a queue. This index covers all of those
+    # without visiting the table.
+    #
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX patron_registration_hold_queue_order '
+            'ON patron_registration (author_id, format_id, language_id, hold_queue_order, id)',
+            'DROP INDEX patron_registration_hold_queue_order'
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-05-23 00:58
+
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+#
+# A copy of patron.models.normalize_author as it was when this migration was written, so that this migration always
+# does the same thing, however the normaliser changes later. Later changes recompute the keys in their own migrations.
+#
+_RELATOR_TERMS_RE = re.compile(
+    r'(?:,\s*(?:joint author|author|editor|compiler|illustrator|translator|narrator|photographer|composer|'
+    r'contributor|creator|adapter|performer)\.?)+\W*$',
+    re.IGNORECASE
+)
+_LIFE_DATES_RE = re.compile(
+    r',\s*(?:b\.|d\.|ca\.|fl\.|active)?\s*\d{3,4}\??\s*-?\s*(?:(?:ca\.)?\s*\d{3,4}\??)?\W*$'
+)
+
+
+def normalize_author(name):
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = _RELATOR_TERMS_RE.sub('', name)
+    name = _LIFE_DATES_RE.sub('', name)
+    name = re.sub(r'[\W_]+', ' ', name.casefold())
+    return name.strip()
+
+
+def set_normalized_keys(apps, schema_editor):
+    Author = apps.get_model('patron', 'Author')
+    for author in Author.objects.all():
+        author.normalized_key = normalize_author(author.name)
+        author.save(update_fields=['normalized_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patron', '0011_registration_queue_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='normalized_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_normalized_keys, migrations.RunPython.noop),
+    ]
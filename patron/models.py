@@ -16,17 +16,52 @@
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from itertools import zip_longest
+import re
+import unicodedata
+
 from django.conf import settings
-from django.db import models
-from django.db.models.expressions import RawSQL
+from django.db import connection, models, transaction
+
+
+# Relator terms, such as the "author" in "Smith, John, 1950-, author.", that may follow a name's life dates.
+_RELATOR_TERMS_RE = re.compile(
+    r'(?:,\s*(?:joint author|author|editor|compiler|illustrator|translator|narrator|photographer|composer|'
+    r'contributor|creator|adapter|performer)\.?)+\W*$',
+    re.IGNORECASE
+)
+# Life dates are only recognised after a comma, so that names that end in a number, such as "Blink-182", keep it.
+_LIFE_DATES_RE = re.compile(
+    r',\s*(?:b\.|d\.|ca\.|fl\.|active)?\s*\d{3,4}\??\s*-?\s*(?:(?:ca\.)?\s*\d{3,4}\??)?\W*$'
+)
+
+
+def normalize_author(name):
+    """
+    Return the key that an author's name is matched on.
+
+    The key ignores case, diacritics, punctuation and spacing, and any life dates and relator terms at the end of the
+    name, so that "Smith, John, 1950-, author." and "SMITH, JOHN." have the same key.
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = _RELATOR_TERMS_RE.sub('', name)
+    name = _LIFE_DATES_RE.sub('', name)
+    name = re.sub(r'[\W_]+', ' ', name.casefold())
+    return name.strip()
 
 
 class Author(models.Model):
     name = models.CharField(max_length=255, unique=True)
+    normalized_key = models.CharField(max_length=255, db_index=True, editable=False)
     friendly_name = models.CharField(max_length=255)
     note = models.TextField(null=True, blank=True)
     patrons = models.ManyToManyField('Patron', through='Registration')
 
+    def save(self, *args, **kwargs):
+        self.normalized_key = normalize_author(self.name)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
@@ -122,13 +157,269 @@ class Registration(models.Model):
         )
 
     def move_to_last_in_hold_queue_order(self):
-        self.hold_queue_order = RawSQL(
-            'SELECT hold_queue_order + 1 '
-            'FROM patron_registration '
-            'WHERE author_id = %s AND format_id = %s AND language_id = %s '
-            'ORDER BY hold_queue_order DESC '
-            'LIMIT 1',
-            (self.author_id, self.format_id, self.language_id)
+        self.hold_queue_order = HoldQueue.move_to_last(self)
+
+
+class HoldQueue(models.Model):
+    """
+    The counter for the hold queue of the registrations for one author, format and language.
+
+    A registration is moved to the end of its hold queue by incrementing the queue's counter and giving the
+    registration the new value, in one statement. The counter's row stays locked until the transaction ends, so
+    concurrent moves to the end of the same hold queue can't give two registrations the same position.
+
+    The counter is never behind the registrations' positions, even if they were edited by hand, because it is first
+    brought up to the largest position in the queue.
+
+    The hold queues of authors whose names normalise to the same key take turns, and turn_order is this hold queue's
+    place in those turns.
+    """
+    author = models.ForeignKey(Author, models.CASCADE)
+    format = models.ForeignKey(Format, models.CASCADE)
+    language = models.ForeignKey(Language, models.CASCADE)
+    last_hold_queue_order = models.IntegerField()
+    turn_order = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('author', 'format', 'language')
+
+    MOVE_TO_LAST_SQL = (
+        'WITH counter AS ('
+        '  INSERT INTO patron_holdqueue AS q (author_id, format_id, language_id, last_hold_queue_order, turn_order)'
+        '  SELECT %(author_id)s, %(format_id)s, %(language_id)s, COALESCE(MAX(hold_queue_order), 0) + 1, 0'
+        '  FROM patron_registration'
+        '  WHERE author_id = %(author_id)s AND format_id = %(format_id)s AND language_id = %(language_id)s'
+        '  ON CONFLICT (author_id, format_id, language_id) DO UPDATE'
+        '  SET last_hold_queue_order = GREATEST(q.last_hold_queue_order + 1, EXCLUDED.last_hold_queue_order)'
+        '  RETURNING q.last_hold_queue_order'
+        ') '
+        'UPDATE patron_registration AS r '
+        'SET hold_queue_order = counter.last_hold_queue_order '
+        'FROM counter '
+        'WHERE r.id = %(registration_id)s '
+        'RETURNING r.hold_queue_order'
+    )
+
+    CREATE_MISSING_SQL = (
+        'INSERT INTO patron_holdqueue (author_id, format_id, language_id, last_hold_queue_order, turn_order) '
+        'SELECT t.author_id, t.format_id, t.language_id, 0, 0 '
+        'FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS t (author_id, format_id, language_id) '
+        'ON CONFLICT (author_id, format_id, language_id) DO NOTHING'
+    )
+
+    SET_TURN_ORDERS_SQL = (
+        'UPDATE patron_holdqueue AS q '
+        'SET turn_order = t.turn_order '
+        'FROM unnest(%s::integer[], %s::integer[], %s::integer[], %s::integer[]) '
+        'AS t (author_id, format_id, language_id, turn_order) '
+        'WHERE q.author_id = t.author_id AND q.format_id = t.format_id AND q.language_id = t.language_id'
+    )
+
+    ROTATE_SQL = (
+        'WITH touched AS ('
+        '  SELECT * FROM unnest(%s::integer[], %s::integer[], %s::integer[], %s::integer[])'
+        '  AS t (author_id, format_id, language_id, n)'
+        '), counter AS ('
+        '  UPDATE patron_holdqueue AS q'
+        '  SET last_hold_queue_order = t.n + GREATEST('
+        '    q.last_hold_queue_order,'
+        '    (SELECT COALESCE(MAX(r.hold_queue_order), 0) FROM patron_registration AS r'
+        '     WHERE r.author_id = q.author_id AND r.format_id = q.format_id AND r.language_id = q.language_id)'
+        '  )'
+        '  FROM touched AS t'
+        '  WHERE q.author_id = t.author_id AND q.format_id = t.format_id AND q.language_id = t.language_id'
+        '  RETURNING q.author_id, q.format_id, q.language_id, q.last_hold_queue_order - t.n AS first_new_order'
+        '), heads AS ('
+        '  SELECT r.id, r.author_id, r.format_id, r.language_id, row_number() OVER ('
+        '    PARTITION BY r.author_id, r.format_id, r.language_id ORDER BY r.hold_queue_order, r.id'
+        '  ) AS position'
+        '  FROM patron_registration AS r'
+        '  JOIN touched AS t USING (author_id, format_id, language_id)'
+        ') '
+        'UPDATE patron_registration AS r '
+        'SET hold_queue_order = c.first_new_order + h.position '
+        'FROM heads AS h '
+        'JOIN touched AS t USING (author_id, format_id, language_id) '
+        'JOIN counter AS c USING (author_id, format_id, language_id) '
+        'WHERE r.id = h.id AND h.position <= t.n '
+        'RETURNING r.id, r.hold_queue_order'
+    )
+
+    @staticmethod
+    def move_to_last(registration):
+        """Move the registration to the end of its hold queue, and return its new position."""
+        with connection.cursor() as cursor:
+            cursor.execute(HoldQueue.MOVE_TO_LAST_SQL, {
+                'author_id': registration.author_id,
+                'format_id': registration.format_id,
+                'language_id': registration.language_id,
+                'registration_id': registration.id,
+            })
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def rotate(rotations):
+        """
+        Rotate many hold queues at once.
+
+        rotations maps (author id, format id, language id) to how many registrations to move from the front of that
+        hold queue to the end of it. Returns a dict that maps the id of each registration that was moved to its new
+        position.
+        """
+        if not rotations:
+            return dict()
+        author_ids, format_ids, language_ids = (list(x) for x in zip(*rotations.keys()))
+        with connection.cursor() as cursor:
+            cursor.execute(HoldQueue.CREATE_MISSING_SQL, (author_ids, format_ids, language_ids))
+            cursor.execute(HoldQueue.ROTATE_SQL, (author_ids, format_ids, language_ids, list(rotations.values())))
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def set_turn_orders(turn_orders):
+        """Save turn_orders, which maps (author id, format id, language id) to that hold queue's turn order."""
+        if not turn_orders:
+            return
+        author_ids, format_ids, language_ids = (list(x) for x in zip(*turn_orders.keys()))
+        with connection.cursor() as cursor:
+            cursor.execute(HoldQueue.CREATE_MISSING_SQL, (author_ids, format_ids, language_ids))
+            cursor.execute(
+                HoldQueue.SET_TURN_ORDERS_SQL, (author_ids, format_ids, language_ids, list(turn_orders.values()))
+            )
+
+    @staticmethod
+    def turn_orders():
+        """Return a dict that maps (author id, format id, language id) to that hold queue's turn order."""
+        return {
+            (author_id, format_id, language_id): turn_order
+            for author_id, format_id, language_id, turn_order in HoldQueue.objects.values_list(
+                'author_id', 'format_id', 'language_id', 'turn_order'
+            )
+        }
+
+
+class RegistrationIndex:
+    """
+    An in-memory index of the active registrations, keyed by (author, format code, language code).
+
+    Registrations for authors whose names normalise to the same key share a queue, but each author's registrations
+    keep the order of their own hold queue in the database. find() returns the registrations for a bib with the
+    authors' hold queues taking turns: the first registration of each, then the second of each, and so on. Moving a
+    registration to the end of its hold queue also sends its author's hold queue to the back of the turns. The turns
+    are saved along with the hold queue orders, so the next index that is loaded carries on from them.
+
+    The registrations come with their patron and pickup location already loaded. Build the index once with load()
+    and then find() the registrations for a bib without touching the database.
+
+    Moving a registration to the end of its hold queue takes effect in the index straight away, but is only saved
+    to the database by save_hold_queue_orders(), along with every other hold queue that has changed since.
+    """
+
+    def __init__(self, registrations, turn_orders=None):
+        # Each key maps to the hold queues of the authors with that key, in turn order. Each hold queue is the list of
+        # its registrations in hold queue order, and is also found by its (author id, format id, language id).
+        # turn_orders maps (author id, format id, language id) to the hold queue's saved turn order.
+        turn_orders = turn_orders or dict()
+        self._queues = dict()
+        self._hold_queues = dict()
+        self._rotations = dict()
+        self._keys_with_new_turns = set()
+        for reg in registrations:
+            queue_ids = self._queue_ids_for(reg)
+            hold_queue = self._hold_queues.get(queue_ids)
+            if hold_queue is None:
+                hold_queue = self._hold_queues[queue_ids] = list()
+                self._queues.setdefault(self._key_for(reg), list()).append(hold_queue)
+            hold_queue.append(reg)
+        for hold_queues in self._queues.values():
+            hold_queues.sort(key=lambda x: (turn_orders.get(self._queue_ids_for(x[0]), 0), x[0].author_id))
+
+    @staticmethod
+    def load():
+        registrations = (
+            Registration.objects.filter(format__active=True, language__active=True)
+            .select_related('author', 'format', 'language', 'patron__pickup_location')
+            .order_by('hold_queue_order', 'id')
+        )
+        return RegistrationIndex(registrations, HoldQueue.turn_orders())
+
+    @staticmethod
+    def key(author, format_code, language_code):
+        return normalize_author(author), format_code, language_code
+
+    @staticmethod
+    def _key_for(registration):
+        return registration.author.normalized_key, registration.format.code, registration.language.code
+
+    @staticmethod
+    def _queue_ids_for(registration):
+        return registration.author_id, registration.format_id, registration.language_id
+
+    def __len__(self):
+        return len(self._queues)
+
+    def keys(self):
+        return self._queues.keys()
+
+    def author_first_word_keys(self):
+        """
+        Return the set of (first word of the author's key, format code, language code) of the registrations, for
+        discovery sources that can only roughly narrow new bibs down to the ones that could match.
+        """
+        return set(
+            (author.split(' ', 1)[0], format_code, language_code)
+            for author, format_code, language_code in self._queues
         )
-        self.save()
-        self.refresh_from_db()
+
+    def matches(self, author, format_code, language_code):
+        return self.key(author, format_code, language_code) in self._queues
+
+    def find(self, author, format_code, language_code):
+        hold_queues = self._queues.get(self.key(author, format_code, language_code), ())
+        return [reg for regs in zip_longest(*hold_queues) for reg in regs if reg is not None]
+
+    def move_to_last_in_hold_queue_order(self, registration):
+        """Move the registration, which must be at the front of its hold queue, to the end of it."""
+        queue_ids = self._queue_ids_for(registration)
+        hold_queue = self._hold_queues[queue_ids]
+        hold_queue.remove(registration)
+        hold_queue.append(registration)
+        key = self._key_for(registration)
+        hold_queues = self._queues[key]
+        if len(hold_queues) > 1:
+            hold_queues.remove(hold_queue)
+            hold_queues.append(hold_queue)
+            self._keys_with_new_turns.add(key)
+        self._rotations[queue_ids] = self._rotations.get(queue_ids, 0) + 1
+
+    def save_hold_queue_orders(self):
+        #
+        # Each hold queue is rotated in the database by as many registrations as were moved from its front to its end.
+        # Rotating a hold queue by its length leaves it as it was, so only the remainder needs to be saved.
+        #
+        # The turns of the authors' hold queues that share a key are saved too, for each key whose turns changed.
+        #
+        # The rotations and turns are only forgotten once they are committed, so that if the transaction they are
+        # saved in is rolled back, they are saved again next time.
+        #
+        saved_rotations = dict(self._rotations)
+        rotations = dict()
+        for queue_ids, n in saved_rotations.items():
+            if n % len(self._hold_queues[queue_ids]):
+                rotations[queue_ids] = n % len(self._hold_queues[queue_ids])
+        new_orders = HoldQueue.rotate(rotations)
+        saved_keys_with_new_turns = set(self._keys_with_new_turns)
+        HoldQueue.set_turn_orders({
+            self._queue_ids_for(hold_queue[0]): turn_order
+            for key in saved_keys_with_new_turns
+            for turn_order, hold_queue in enumerate(self._queues[key])
+        })
+
+        def _forget_saved_rotations():
+            for queue_ids, n in saved_rotations.items():
+                self._rotations[queue_ids] -= n
+                if self._rotations[queue_ids] == 0:
+                    del self._rotations[queue_ids]
+                for reg in self._hold_queues[queue_ids]:
+                    reg.hold_queue_order = new_orders.get(reg.id, reg.hold_queue_order)
+            self._keys_with_new_turns -= saved_keys_with_new_turns
+        transaction.on_commit(_forget_saved_rotations)
@@ -16,6 +16,171 @@
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.test import TestCase
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
 
-# Create your tests here.
+from .models import (
+    Author, Format, HoldQueue, Language, Patron, PickupLocation, Registration, RegistrationIndex, normalize_author
+)
+
+
+class NormalizeAuthorTests(SimpleTestCase):
+
+    def test_ignores_case_diacritics_and_punctuation(self):
+        self.assertEqual(normalize_author('SMITH, JOHN.'), 'smith john')
+        self.assertEqual(normalize_author('Brontë,  Charlotte'), 'bronte charlotte')
+
+    def test_removes_life_dates(self):
+        self.assertEqual(normalize_author('Smith, John, 1950-'), 'smith john')
+        self.assertEqual(normalize_author('Bronte, Charlotte, 1816-1855.'), 'bronte charlotte')
+        self.assertEqual(normalize_author('Smith, John, b. 1950'), 'smith john')
+        self.assertEqual(normalize_author('Smith, John, ca. 1500-ca. 1560'), 'smith john')
+
+    def test_removes_relator_terms_after_life_dates(self):
+        self.assertEqual(normalize_author('Smith, John, 1952-2001, author.'), 'smith john')
+        self.assertEqual(normalize_author('Smith, John, 1950-, author, illustrator.'), 'smith john')
+        self.assertEqual(normalize_author('Smith, John, editor.'), 'smith john')
+
+    def test_keeps_numbers_that_are_part_of_the_name(self):
+        self.assertEqual(normalize_author('Blink-182'), 'blink 182')
+        self.assertEqual(normalize_author('Maroon 5'), 'maroon 5')
+
+
+class RegistrationFixtureMixin:
+
+    def setUp(self):
+        self.format = Format.objects.create(code='a', value='Book')
+        self.language = Language.objects.create(code='eng', name='English')
+        self.pickup_location = PickupLocation.objects.create(code='a', name='Main library')
+        self.num_patrons = 0
+
+    def _patron(self):
+        self.num_patrons += 1
+        return Patron.objects.create(
+            patron_record_number=1000000 + self.num_patrons,
+            pickup_location=self.pickup_location,
+            default_format=self.format,
+            default_language=self.language
+        )
+
+    def _registration(self, author, hold_queue_order):
+        return Registration.objects.create(
+            patron=self._patron(),
+            author=author,
+            format=self.format,
+            language=self.language,
+            hold_queue_order=hold_queue_order
+        )
+
+
+class HoldQueueTests(RegistrationFixtureMixin, TestCase):
+
+    def _queue_ids(self, author):
+        return author.id, self.format.id, self.language.id
+
+    def _order(self, author):
+        return list(
+            Registration.objects.filter(author=author).order_by('hold_queue_order', 'id').values_list('id', flat=True)
+        )
+
+    def test_rotate_moves_registrations_from_the_front_to_the_end(self):
+        author = Author.objects.create(name='Smith, John', friendly_name='John Smith')
+        other_author = Author.objects.create(name='Jones, Mary', friendly_name='Mary Jones')
+        r1, r2, r3 = (self._registration(author, i) for i in (1, 2, 3))
+        other = self._registration(other_author, 1)
+        moved = HoldQueue.rotate({self._queue_ids(author): 2})
+        self.assertEqual(moved, {r1.id: 4, r2.id: 5})
+        self.assertEqual(self._order(author), [r3.id, r1.id, r2.id])
+        # The counter keeps track of the end of the queue, so the next rotation continues from it.
+        self.assertEqual(HoldQueue.rotate({self._queue_ids(author): 1}), {r3.id: 6})
+        self.assertEqual(self._order(author), [r1.id, r2.id, r3.id])
+        # Other hold queues are left alone.
+        other.refresh_from_db()
+        self.assertEqual(other.hold_queue_order, 1)
+
+    def test_rotate_nothing(self):
+        self.assertEqual(HoldQueue.rotate(dict()), dict())
+
+
+class RegistrationIndexTests(RegistrationFixtureMixin, TestCase):
+
+    def _find(self, index):
+        return [x.id for x in index.find('Smith, John', 'a', 'eng')]
+
+    def test_authors_with_the_same_key_share_a_queue_but_keep_their_own_order(self):
+        author_a = Author.objects.create(name='Smith, John', friendly_name='John Smith')
+        author_b = Author.objects.create(name='SMITH, JOHN, 1950-', friendly_name='John Smith')
+        self.assertEqual(author_a.normalized_key, author_b.normalized_key)
+        a1 = self._registration(author_a, 5)
+        a2 = self._registration(author_a, 6)
+        b1 = self._registration(author_b, 1)
+        index = RegistrationIndex.load()
+        self.assertEqual(len(index), 1)
+        # The authors' own hold queues take turns, in author id order.
+        self.assertEqual(self._find(index), [a1.id, b1.id, a2.id])
+        #
+        # Moving author A's front registration three times rotates A's two registrations by one, however many
+        # registrations the shared queue has.
+        #
+        for _ in range(3):
+            index.move_to_last_in_hold_queue_order(
+                next(x for x in index.find('Smith, John', 'a', 'eng') if x.author_id == author_a.id)
+            )
+        index.save_hold_queue_orders()
+        a1.refresh_from_db()
+        a2.refresh_from_db()
+        b1.refresh_from_db()
+        self.assertLess(a2.hold_queue_order, a1.hold_queue_order)
+        self.assertEqual(b1.hold_queue_order, 1)
+        # Author A's hold queue was sent to the back of the turns, and stays there when the index is loaded again.
+        self.assertEqual(self._find(index), [b1.id, a2.id, a1.id])
+        self.assertEqual(self._find(RegistrationIndex.load()), [b1.id, a2.id, a1.id])
+
+    def test_the_turns_carry_on_from_one_load_to_the_next(self):
+        author_a = Author.objects.create(name='Smith, John', friendly_name='John Smith')
+        author_b = Author.objects.create(name='SMITH, JOHN, 1950-', friendly_name='John Smith')
+        a1 = self._registration(author_a, 1)
+        a2 = self._registration(author_a, 2)
+        b1 = self._registration(author_b, 1)
+        b2 = self._registration(author_b, 2)
+        #
+        # Each run loads the index, finds one bib for the key, and moves the registration at the front to the end, as
+        # autoholds does. Every registration gets its turn at the front.
+        #
+        fronts = list()
+        for _ in range(4):
+            index = RegistrationIndex.load()
+            front = index.find('Smith, John', 'a', 'eng')[0]
+            fronts.append(front.id)
+            index.move_to_last_in_hold_queue_order(front)
+            index.save_hold_queue_orders()
+        self.assertEqual(fronts, [a1.id, b1.id, a2.id, b2.id])
+
+
+class RegistrationQueueIndexTests(RegistrationFixtureMixin, TestCase):
+
+    def _plan(self, sql, params):
+        with connection.cursor() as cursor:
+            # The fixture is far too small for the planner to choose an index over a sequential scan by itself.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return '\n'.join(x[0] for x in cursor.fetchall())
+
+    def test_queue_lookups_use_the_queue_index(self):
+        author = Author.objects.create(name='Smith, John', friendly_name='John Smith')
+        other_author = Author.objects.create(name='Jones, Mary', friendly_name='Mary Jones')
+        for i in range(20):
+            self._registration(author if i % 2 else other_author, i)
+        # The registrations at the front of a hold queue, in hold queue order.
+        queue = (
+            Registration.objects.filter(author=author, format=self.format, language=self.language)
+            .order_by('hold_queue_order', 'id')
+            .values_list('id', flat=True)
+        )
+        self.assertIn('patron_registration_hold_queue_order', self._plan(*queue.query.sql_with_params()))
+        # The last position in a hold queue.
+        self.assertIn('patron_registration_hold_queue_order', self._plan(
+            'SELECT MAX(hold_queue_order) FROM patron_registration '
+            'WHERE author_id = %s AND format_id = %s AND language_id = %s',
+            [author.id, self.format.id, self.language.id]
+        ))
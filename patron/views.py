@@ -107,7 +107,7 @@ def login(request):
     if not barcode:
         messages.info(request, 'Enter your barcode before trying to log in.')
         return render(request, 'patron/login.html')
-    sierra_api = _sierra_api_in_session(request)
+    sierra_api = _sierra_api()
     sierra_patron = sierra_api.patrons_find(barcode, fields='id,names,fixedFields')
     if not sierra_patron:
         messages.info(request, 'The barcode you entered seems to be incorrect.')
@@ -136,18 +136,8 @@ def remove_registration(request):
     return HttpResponseRedirect(reverse('patron:account'))
 
 
-def _sierra_api_in_session(request):
-    try:
-        access_token = request.session['sierra_api_access_token']
-        return SierraApi_v2.attach(settings.SIERRA_API.base_url, access_token)
-    except KeyError:
-        sierra_api = SierraApi_v2.login(
-            settings.SIERRA_API.base_url,
-            settings.SIERRA_API.client_key,
-            settings.SIERRA_API.client_secret
-        )
-        request.session['sierra_api_access_token'] = sierra_api.access_token
-        return sierra_api
+def _sierra_api():
+    return SierraApi_v2.from_settings(settings.SIERRA_API)
 
 
 def _patron_in_session(request):
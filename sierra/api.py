@@ -17,14 +17,30 @@
 
 
 from base64 import b64encode
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime, timezone
+from hashlib import sha1
+import json
+import random
+import re
+import threading
+import time
+import zlib
 
+from django.core.cache import cache
 from django.utils.dateparse import parse_datetime
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class SierraApiError(Exception):
 
+    # Sierra reports a hold request that it refuses, for example because the patron is blocked or already has a hold
+    # on the record, as an XCirc error. Making the same request again won't help.
+    XCIRC_ERROR_CODE = 132
+
     def __init__(self, **kwargs):
         self.http_status = kwargs.get('httpStatus', kwargs.get('http_status', None))
         self.name = kwargs.get('name', None)
@@ -32,6 +48,13 @@ class SierraApiError(Exception):
         self.description = kwargs.get('description', None)
         self.specific_code = kwargs.get('specificCode', kwargs.get('specific_code', None))
 
+    @property
+    def is_transient(self):
+        """Whether the request that failed with this error might succeed if it is made again later."""
+        if self.code == self.XCIRC_ERROR_CODE:
+            return False
+        return self.http_status is None or self.http_status == 429 or self.http_status >= 500
+
     def __str__(self):
         if self.description:
             return '%s (name: %s, code: %s, specific code: %s, http status: %s)' % (
@@ -43,13 +66,324 @@ class SierraApiError(Exception):
             )
 
 
+_ENTRIES_START_RE = re.compile(r'"entries"\s*:\s*\[')
+_ENTRIES_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+def _iter_json_entries(byte_chunks):
+    """
+    Yield the entries of a Sierra API result set, such as {"total": 2, "start": 0, "entries": [{...}, {...}]},
+    decoding each entry as soon as byte_chunks has provided all of it, rather than decoding the whole result set
+    at once.
+
+    Only the text after the last entry that was decoded is kept, so memory is bounded by a chunk and an entry.
+    The result set's other fields come before its entries, and are numbers, so they can't contain "entries".
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_entries = False
+    for chunk in byte_chunks:
+        buffer += text_decoder.decode(chunk)
+        if not in_entries:
+            match = _ENTRIES_START_RE.search(buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            in_entries = True
+        pos = 0
+        while True:
+            pos = _ENTRIES_SEPARATOR_RE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                entry, pos_after = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The rest of this entry hasn't arrived yet.
+                break
+            pos = pos_after
+            yield entry
+        buffer = buffer[pos:]
+    if in_entries:
+        raise ValueError('The result set ended part way through its entries')
+
+
+def _decoded_chunks(body, content_encoding, chunk_size):
+    # Yields the content of an HTTP response body, chunk_size bytes of the body at a time, decompressing it if needed.
+    if content_encoding in ('gzip', 'deflate'):
+        # Adding 32 to wbits accepts either a gzip or a zlib header.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        for i in range(0, len(body), chunk_size):
+            yield decompressor.decompress(body[i:i + chunk_size])
+        yield decompressor.flush()
+    else:
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+
+_shared_objects = dict()
+_shared_objects_lock = threading.Lock()
+
+
+def _shared_for_settings(kind, sierra_api_settings, factory):
+    # Returns the object of this kind that's shared by everything in this process that uses these SierraApiSettings.
+    key = (kind, sierra_api_settings.base_url, sierra_api_settings.client_key)
+    with _shared_objects_lock:
+        try:
+            return _shared_objects[key]
+        except KeyError:
+            shared_object = factory()
+            _shared_objects[key] = shared_object
+            return shared_object
+
+
+def _setting(sierra_api_settings, name, default):
+    # Settings added since SierraApiSettings was first released may be missing from older sierrasettings.py files.
+    return getattr(sierra_api_settings, name, default)
+
+
+def _rate_limiter_for_settings(sierra_api_settings):
+    # Returns the TokenBucket shared by every client in this process that uses these SierraApiSettings, or None if
+    # they don't set a rate limit.
+    rate_limit = _setting(sierra_api_settings, 'rate_limit', None)
+    if not rate_limit:
+        return None
+    return _shared_for_settings(
+        'rate_limiter', sierra_api_settings,
+        lambda: TokenBucket(rate_limit, _setting(sierra_api_settings, 'rate_limit_burst', None))
+    )
+
+
+def _backoff_delay(attempt, retry_after, backoff_factor, max_backoff):
+    # Returns how many seconds to wait before retrying a request for the attempt'th time (counting from 0).
+    try:
+        return min(float(retry_after), max_backoff)
+    except (TypeError, ValueError):
+        # Exponential backoff with "full jitter"
+        return random.uniform(0, min(backoff_factor * (2 ** attempt), max_backoff))
+
+
+def _boolean_parameter(value):
+    # The Sierra API wants lowercase booleans in query strings, which neither requests nor aiohttp produce.
+    return 'true' if value else 'false'
+
+
+class TokenBucket:
+    """
+    A thread-safe rate limiter that allows, on average, rate calls to acquire() per second, in bursts of up to
+    capacity calls.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self):
+        """Take a token without waiting for it, and return how many seconds the caller must wait before using it."""
+        with self._lock:
+            current_time = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (current_time - self._updated_at) * self.rate)
+            self._updated_at = current_time
+            # Take the token now, even if that leaves the bucket in debt, and then wait for the debt to be repaid.
+            # This keeps the callers in the order they arrived in.
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class SierraSession(requests.Session):
+    """
+    A requests session for the Sierra API that keeps up to pool_size connections to each host open between requests,
+    so that requests after the first don't pay for a new connection and TLS handshake.
+
+    With pool_block, no more than pool_size connections to each host are made at once, and requests wait for a free
+    connection. Otherwise extra connections are made when needed, but not kept open.
+    """
+
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, *, pool_size=DEFAULT_POOL_SIZE, pool_block=False, keep_alive=True, compress=True):
+        super().__init__()
+        self.pool_size = 0
+        self.pool_block = pool_block
+        self._pool_lock = threading.Lock()
+        self.headers['Accept'] = 'application/json'
+        self.headers['Accept-Encoding'] = 'gzip, deflate' if compress else 'identity'
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+        self.ensure_pool_size(pool_size)
+
+    def ensure_pool_size(self, pool_size):
+        """Allow at least pool_size connections to each host to be kept open and used concurrently."""
+        with self._pool_lock:
+            if pool_size > self.pool_size:
+                adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=self.pool_block)
+                self.mount('http://', adapter)
+                self.mount('https://', adapter)
+                self.pool_size = pool_size
+
+
+class SierraTokenProvider:
+    """
+    Gets access tokens for the Sierra API using the client credentials grant, and keeps using the same access token
+    until shortly before it expires.
+
+    The access token is cached both in the provider and in Django's cache. The provider is safe to share between
+    threads, and when Django's cache is shared (e.g. memcached), so is the access token across processes.
+    """
+
+    # Get a new access token this many seconds before the current one expires.
+    REFRESH_MARGIN = 60
+
+    @staticmethod
+    def for_settings(sierra_api_settings):
+        """Return the provider shared by everything in this process that uses these SierraApiSettings."""
+        return _shared_for_settings(
+            'token_provider', sierra_api_settings,
+            lambda: SierraTokenProvider(
+                sierra_api_settings.base_url,
+                sierra_api_settings.client_key,
+                sierra_api_settings.client_secret,
+                timeout=_setting(sierra_api_settings, 'timeout', SierraApi_v2.DEFAULT_TIMEOUT)
+            )
+        )
+
+    def __init__(self, base_url, client_key, client_secret, *, timeout=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client_key = client_key
+        self._client_secret = client_secret
+        self._cache_key = 'sierra-api-access-token-' + sha1('{}|{}'.format(base_url, client_key).encode()).hexdigest()
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+
+    def get_access_token(self):
+        with self._lock:
+            if not self._is_fresh():
+                if not self._use_cached_access_token():
+                    self._request_access_token()
+            return self._access_token
+
+    def refresh(self, stale_access_token):
+        """
+        Return a new access token to replace one the Sierra API rejected.
+
+        If another thread or process has already replaced stale_access_token, its replacement is returned instead of
+        requesting another one.
+        """
+        with self._lock:
+            if self._access_token == stale_access_token or not self._is_fresh():
+                if not self._use_cached_access_token(exclude=stale_access_token):
+                    self._request_access_token()
+            return self._access_token
+
+    def _is_fresh(self):
+        return self._access_token is not None and time.time() < self._expires_at - self.REFRESH_MARGIN
+
+    def _use_cached_access_token(self, exclude=None):
+        cached = cache.get(self._cache_key)
+        if cached is None:
+            return False
+        access_token, expires_at = cached
+        if access_token == exclude or time.time() >= expires_at - self.REFRESH_MARGIN:
+            return False
+        self._access_token = access_token
+        self._expires_at = expires_at
+        return True
+
+    def _request_access_token(self):
+        encoded_secret = b64encode('{}:{}'.format(self._client_key, self._client_secret).encode()).decode()
+        response = requests.post(
+            self.base_url + '/v2/token',
+            headers={'Authorization': 'Basic ' + encoded_secret},
+            data={'grant_type': 'client_credentials'},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        result = response.json()
+        expires_in = int(result.get('expires_in', 3600))
+        self._access_token = result['access_token']
+        self._expires_at = time.time() + expires_in
+        cache.set(
+            self._cache_key,
+            (self._access_token, self._expires_at),
+            max(expires_in - self.REFRESH_MARGIN, 1)
+        )
+
+
 class SierraApi_v2:
 
+    BIBS_MAXIMUM_LIMIT = 2000
+    # Bib ids are passed in the query string, so keep each request's list of them well short of URL length limits.
+    BIBS_MAXIMUM_IDS = 500
+    # Pages of bibs are decoded this many bytes at a time.
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_BACKOFF_FACTOR = 0.5
+    DEFAULT_MAX_BACKOFF = 60
+
+    # GET requests are retried after any of these statuses, or any connection error or timeout.
+    RETRY_GET_STATUSES = frozenset([429, 500, 502, 503, 504])
+    # Other requests are only retried when the Sierra API certainly didn't act on them.
+    RETRY_OTHER_STATUSES = frozenset([429, 503])
+
+    @staticmethod
+    def from_settings(sierra_api_settings):
+        """
+        Return a client configured by these SierraApiSettings.
+
+        The client shares its connection pool, token provider and rate limiter with every other client in this process
+        that uses the same settings.
+        """
+        session = _shared_for_settings(
+            'session', sierra_api_settings,
+            lambda: SierraSession(
+                pool_size=_setting(sierra_api_settings, 'pool_size', SierraSession.DEFAULT_POOL_SIZE),
+                pool_block=_setting(sierra_api_settings, 'pool_block', False),
+                keep_alive=_setting(sierra_api_settings, 'keep_alive', True),
+                compress=_setting(sierra_api_settings, 'compress', True)
+            )
+        )
+        token_provider = SierraTokenProvider.for_settings(sierra_api_settings)
+        sierra_api = SierraApi_v2(
+            sierra_api_settings.base_url,
+            token_provider,
+            timeout=_setting(sierra_api_settings, 'timeout', SierraApi_v2.DEFAULT_TIMEOUT),
+            max_retries=_setting(sierra_api_settings, 'max_retries', SierraApi_v2.DEFAULT_MAX_RETRIES),
+            backoff_factor=_setting(sierra_api_settings, 'backoff_factor', SierraApi_v2.DEFAULT_BACKOFF_FACTOR),
+            max_backoff=_setting(sierra_api_settings, 'max_backoff', SierraApi_v2.DEFAULT_MAX_BACKOFF),
+            rate_limiter=_rate_limiter_for_settings(sierra_api_settings),
+            session=session
+        )
+        sierra_api._do_attach(token_provider.get_access_token())
+        return sierra_api
+
     @staticmethod
     def login(base_url, client_key, client_secret):
-        sierra_api = SierraApi_v2(base_url)
-        access_token = sierra_api._do_login(client_key, client_secret)
-        sierra_api._do_attach(access_token)
+        return SierraApi_v2.connect(SierraTokenProvider(base_url, client_key, client_secret))
+
+    @staticmethod
+    def connect(token_provider):
+        """
+        Return a client that gets its access tokens from token_provider.
+
+        The client uses a new access token when the current one is about to expire, and when the Sierra API
+        rejects the current one it gets a new one and tries the request again, once.
+        """
+        sierra_api = SierraApi_v2(token_provider.base_url, token_provider)
+        sierra_api._do_attach(token_provider.get_access_token())
         return sierra_api
 
     @staticmethod
@@ -58,39 +392,85 @@ class SierraApi_v2:
         sierra_api._do_attach(access_token)
         return sierra_api
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, token_provider=None, *, timeout=DEFAULT_TIMEOUT, max_retries=0,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, max_backoff=DEFAULT_MAX_BACKOFF, rate_limiter=None,
+                 session=None):
         self.base_url = base_url
-        self._session = requests.session()
+        self.token_provider = token_provider
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter
+        self._session = session if session is not None else SierraSession()
         self.access_token = None
 
+    def set_pool_size(self, pool_size):
+        """Allow at least pool_size connections to the Sierra API to be kept open and used concurrently."""
+        self._session.ensure_pool_size(pool_size)
+
     def _absolute_url(self, relative_url):
         return self.base_url + '/v2/' + relative_url
 
-    def _do_login(self, client_key, client_secret):
-        encoded_secret = b64encode('{}:{}'.format(client_key, client_secret).encode()).decode()
-        response = self._session.post(
-            self._absolute_url('token'),
-            headers={'Authorization': 'Basic ' + encoded_secret},
-            data={'grant_type': 'client_credentials'}
-        )
-        response.raise_for_status()
-        access_token = response.json()['access_token']
-        return access_token
-
     def _do_attach(self, access_token):
+        # The session, which may be shared, already sends the Accept header.
         self.access_token = access_token
-        self._session.headers.update({
-            'Authorization': 'Bearer {}'.format(access_token),
-            'Accept': 'application/json',
-        })
 
-    def _get(self, relative_url, params=None):
-        return self._session.get(self._absolute_url(relative_url), params=params)
+    def _request(self, method, relative_url, **kwargs):
+        if self.token_provider is not None:
+            self.access_token = self.token_provider.get_access_token()
+        access_token = self.access_token
+        response = self._send(method, relative_url, access_token, **kwargs)
+        if response.status_code == 401 and self.token_provider is not None:
+            response.close()
+            access_token = self.token_provider.refresh(access_token)
+            self.access_token = access_token
+            response = self._send(method, relative_url, access_token, **kwargs)
+        return response
+
+    def _send(self, method, relative_url, access_token, **kwargs):
+        # The Authorization header is sent per request, rather than set on the session, so that a client shared
+        # between threads can change its access token safely.
+        if method == 'GET':
+            retry_statuses = self.RETRY_GET_STATUSES
+            retry_exceptions = (requests.ConnectionError, requests.Timeout)
+        else:
+            retry_statuses = self.RETRY_OTHER_STATUSES
+            retry_exceptions = (requests.exceptions.ConnectTimeout,)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self._session.request(
+                    method, self._absolute_url(relative_url),
+                    headers={'Authorization': 'Bearer {}'.format(access_token)},
+                    timeout=self.timeout,
+                    **kwargs
+                )
+            except retry_exceptions:
+                if attempt >= self.max_retries:
+                    raise
+                delay = _backoff_delay(attempt, None, self.backoff_factor, self.max_backoff)
+            else:
+                if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                    return response
+                delay = _backoff_delay(
+                    attempt, response.headers.get('Retry-After'), self.backoff_factor, self.max_backoff
+                )
+                # Release the connection of a streamed response that won't be read.
+                response.close()
+            attempt += 1
+            time.sleep(delay)
+
+    def _get(self, relative_url, params=None, **kwargs):
+        return self._request('GET', relative_url, params=params, **kwargs)
 
     def _post_json(self, relative_url, json):
-        return self._session.post(self._absolute_url(relative_url), json=json)
+        return self._request('POST', relative_url, json=json)
 
-    def _date_parameter(self, date_spec):
+    @staticmethod
+    def _date_parameter(date_spec):
         def _convert_range_part(range_part):
             if range_part is None:
                 return ''
@@ -105,8 +485,23 @@ class SierraApi_v2:
         else:
             return str(date_spec)
 
-    def bibs_get(self, *, limit=None, offset=None, fields=None, created_date=None, deleted=None, suppressed=None):
+    def bibs_get(self, *, ids=None, limit=None, offset=None, fields=None, created_date=None, deleted=None,
+                 suppressed=None):
+        params = self._bibs_params(ids, limit, offset, fields, created_date, deleted, suppressed)
+        response = self._get('bibs', params)
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 404:
+            return {'total': 0, 'entries': list()}
+        else:
+            raise SierraApiError(**response.json())
+
+    @staticmethod
+    def _bibs_params(ids, limit, offset, fields, created_date, deleted, suppressed):
+        # Shared with AsyncSierraApi_v2, so both clients send the same query string.
         params = dict()
+        if ids is not None:
+            params['id'] = ','.join(str(int(x)) for x in ids)
         if limit is not None:
             params['limit'] = int(limit)
         if offset is not None:
@@ -114,18 +509,70 @@ class SierraApi_v2:
         if fields is not None:
             params['fields'] = str(fields)
         if created_date is not None:
-            params['createdDate'] = self._date_parameter(created_date)
+            params['createdDate'] = SierraApi_v2._date_parameter(created_date)
         if deleted is not None:
-            params['deleted'] = bool(deleted)
+            params['deleted'] = _boolean_parameter(deleted)
         if suppressed is not None:
-            params['suppressed'] = bool(suppressed)
-        response = self._get('bibs', params)
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 404:
-            return {'total': 0, 'entries': list()}
-        else:
-            raise SierraApiError(**response.json())
+            params['suppressed'] = _boolean_parameter(suppressed)
+        return params
+
+    def bibs_iter(self, *, page_size=BIBS_MAXIMUM_LIMIT, fields=None, created_date=None, deleted=None,
+                  suppressed=None):
+        """
+        Yield every bib matching the criteria, one at a time, paging through them with limit and offset.
+
+        Each page is downloaded in the background, as it came over the wire (so still compressed, if it was), and the
+        bibs are then decoded from it one at a time, so a whole page of bibs is never held in memory at once. The next
+        page is downloaded as soon as the current one has been, while the current one's bibs are being used. When the
+        current page turns out to be the last, the next one is thrown away.
+        """
+        page_size = min(int(page_size), self.BIBS_MAXIMUM_LIMIT)
+
+        def _get_page(offset):
+            params = self._bibs_params(None, page_size, offset, fields, created_date, deleted, suppressed)
+            # requests 2.9's Response isn't a context manager, so it is closed with closing().
+            with closing(self._get('bibs', params, stream=True)) as response:
+                body = response.raw.read(decode_content=False)
+                return response.status_code, response.headers.get('Content-Encoding'), body
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            offset = 0
+            next_page = executor.submit(_get_page, offset)
+            while next_page is not None:
+                status_code, content_encoding, body = next_page.result()
+                next_page = None
+                chunks = _decoded_chunks(body, content_encoding, self.STREAM_CHUNK_SIZE)
+                if status_code == 404:
+                    break
+                elif status_code != 200:
+                    raise SierraApiError(**json.loads(b''.join(chunks).decode()))
+                offset += page_size
+                next_page = executor.submit(_get_page, offset)
+                num_entries = 0
+                for entry in _iter_json_entries(chunks):
+                    num_entries += 1
+                    yield entry
+                if num_entries < page_size:
+                    # The next page, which is being downloaded, is thrown away.
+                    break
+
+    def bibs_get_many(self, ids, *, fields=None, max_workers=4):
+        """
+        Yield the bib for each of the ids, in the same order as the ids, or None for each id that has no bib.
+
+        The ids are fetched BIBS_MAXIMUM_IDS at a time, with up to max_workers requests in flight at once.
+        """
+        ids = [int(x) for x in ids]
+        chunks = [ids[i:i + self.BIBS_MAXIMUM_IDS] for i in range(0, len(ids), self.BIBS_MAXIMUM_IDS)]
+
+        def _get_chunk(chunk):
+            entries = self.bibs_get(ids=chunk, limit=len(chunk), fields=fields)['entries']
+            return {int(x['id']): x for x in entries}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            for chunk, bibs_by_id in zip(chunks, executor.map(_get_chunk, chunks)):
+                for bib_id in chunk:
+                    yield bibs_by_id.get(bib_id)
 
     def bibs_get_for_id(self, bib_id, *, fields=None):
         params = None if fields is None else {'fields': fields}
@@ -0,0 +1,226 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .api import SierraApi_v2, SierraApiError, SierraTokenProvider, _backoff_delay, _rate_limiter_for_settings, _setting
+
+
+async def in_completion_order(coroutines):
+    """
+    Run the coroutines concurrently, and return the (index, task) for each of them, in the order they completed in.
+
+    A task's result() returns what its coroutine returned, or raises what it raised.
+    """
+    tasks = {asyncio.ensure_future(x): i for i, x in enumerate(coroutines)}
+    completed = list()
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        completed.extend(sorted(((tasks[x], x) for x in done), key=lambda x: x[0]))
+    return completed
+
+
+class AsyncSierraApi_v2:
+    """
+    An asyncio client for the Sierra API, with the same methods and errors as SierraApi_v2, but as coroutines.
+
+    Up to max_concurrency requests are in flight at once, over connections that are kept alive between requests.
+    Getting an access token still blocks, so it is done on the event loop's default executor.
+
+    Needs Python 3.5 or later and aiohttp, which is not otherwise required by AutoHolds.
+    """
+
+    BIBS_MAXIMUM_LIMIT = SierraApi_v2.BIBS_MAXIMUM_LIMIT
+
+    DEFAULT_MAX_CONCURRENCY = 100
+    DEFAULT_KEEP_ALIVE = 30
+
+    RETRY_GET_STATUSES = SierraApi_v2.RETRY_GET_STATUSES
+    RETRY_OTHER_STATUSES = SierraApi_v2.RETRY_OTHER_STATUSES
+
+    @staticmethod
+    def from_settings(sierra_api_settings, *, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """
+        Return a client configured by these SierraApiSettings.
+
+        The client shares its token provider and rate limiter with every SierraApi_v2 in this process that uses the
+        same settings.
+        """
+        return AsyncSierraApi_v2(
+            sierra_api_settings.base_url,
+            SierraTokenProvider.for_settings(sierra_api_settings),
+            timeout=_setting(sierra_api_settings, 'timeout', SierraApi_v2.DEFAULT_TIMEOUT),
+            max_retries=_setting(sierra_api_settings, 'max_retries', SierraApi_v2.DEFAULT_MAX_RETRIES),
+            backoff_factor=_setting(sierra_api_settings, 'backoff_factor', SierraApi_v2.DEFAULT_BACKOFF_FACTOR),
+            max_backoff=_setting(sierra_api_settings, 'max_backoff', SierraApi_v2.DEFAULT_MAX_BACKOFF),
+            max_concurrency=max_concurrency,
+            rate_limiter=_rate_limiter_for_settings(sierra_api_settings)
+        )
+
+    @staticmethod
+    def login(base_url, client_key, client_secret, **kwargs):
+        return AsyncSierraApi_v2(base_url, SierraTokenProvider(base_url, client_key, client_secret), **kwargs)
+
+    def __init__(self, base_url, token_provider, *, timeout=SierraApi_v2.DEFAULT_TIMEOUT, max_retries=0,
+                 backoff_factor=SierraApi_v2.DEFAULT_BACKOFF_FACTOR, max_backoff=SierraApi_v2.DEFAULT_MAX_BACKOFF,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, keep_alive=DEFAULT_KEEP_ALIVE, rate_limiter=None):
+        if aiohttp is None:
+            raise ImportError('AsyncSierraApi_v2 needs aiohttp, which is not installed')
+        self.base_url = base_url
+        self.token_provider = token_provider
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.keep_alive = keep_alive
+        self.rate_limiter = rate_limiter
+        self.access_token = None
+        # The session and semaphore belong to an event loop, so they're created on first use, inside the loop.
+        self._session = None
+        self._semaphore = None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _absolute_url(self, relative_url):
+        return self.base_url + '/v2/' + relative_url
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=self.keep_alive),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Accept': 'application/json'}
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _get_access_token(self, stale_access_token=None):
+        loop = asyncio.get_event_loop()
+        if stale_access_token is None:
+            return await loop.run_in_executor(None, self.token_provider.get_access_token)
+        else:
+            return await loop.run_in_executor(None, self.token_provider.refresh, stale_access_token)
+
+    async def _request(self, method, relative_url, **kwargs):
+        # Returns the response's status and its decoded JSON body, or None if it has no body.
+        access_token = self.access_token = await self._get_access_token()
+        status, body = await self._send(method, relative_url, access_token, **kwargs)
+        if status == 401:
+            access_token = self.access_token = await self._get_access_token(access_token)
+            status, body = await self._send(method, relative_url, access_token, **kwargs)
+        return status, body
+
+    async def _send(self, method, relative_url, access_token, **kwargs):
+        session = self._get_session()
+        if method == 'GET':
+            retry_statuses = self.RETRY_GET_STATUSES
+            retry_exceptions = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+        else:
+            retry_statuses = self.RETRY_OTHER_STATUSES
+            retry_exceptions = (aiohttp.ClientConnectorError,)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                async with self._semaphore:
+                    async with session.request(
+                        method, self._absolute_url(relative_url),
+                        headers={'Authorization': 'Bearer {}'.format(access_token)},
+                        **kwargs
+                    ) as response:
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        text = await response.text()
+            except retry_exceptions:
+                if attempt >= self.max_retries:
+                    raise
+                delay = _backoff_delay(attempt, None, self.backoff_factor, self.max_backoff)
+            else:
+                if status not in retry_statuses or attempt >= self.max_retries:
+                    return status, json.loads(text) if text else None
+                delay = _backoff_delay(attempt, retry_after, self.backoff_factor, self.max_backoff)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _error(body):
+        return SierraApiError(**(body or dict()))
+
+    async def bibs_get(self, *, ids=None, limit=None, offset=None, fields=None, created_date=None, deleted=None,
+                       suppressed=None):
+        params = SierraApi_v2._bibs_params(ids, limit, offset, fields, created_date, deleted, suppressed)
+        status, body = await self._request('GET', 'bibs', params=params)
+        if status == 200:
+            return body
+        elif status == 404:
+            return {'total': 0, 'entries': list()}
+        else:
+            raise self._error(body)
+
+    async def bibs_get_for_id(self, bib_id, *, fields=None):
+        params = None if fields is None else {'fields': fields}
+        status, body = await self._request('GET', 'bibs/{}'.format(bib_id), params=params)
+        if status == 200:
+            return body
+        else:
+            raise self._error(body)
+
+    async def patrons_find(self, barcode, *, fields):
+        params = {'barcode': str(barcode)}
+        if fields is not None:
+            params['fields'] = str(fields)
+        status, body = await self._request('GET', 'patrons/find', params=params)
+        if status == 200:
+            return body
+        elif status == 404:
+            return
+        else:
+            raise self._error(body)
+
+    async def patrons_place_hold(self, patron_rec_num, record_type, record_rec_num, pickup_location):
+        json = {
+            'recordType': str(record_type),
+            'recordNumber': int(record_rec_num),
+            'pickupLocation': str(pickup_location)
+        }
+        status, body = await self._request('POST', 'patrons/{}/holds/requests'.format(patron_rec_num), json=json)
+        if status == 200:
+            return
+        else:
+            raise self._error(body)
+
+    parse_datetime = staticmethod(SierraApi_v2.parse_datetime)
@@ -0,0 +1,192 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import namedtuple
+from datetime import timezone
+import unicodedata
+
+from django.db import connections, transaction
+
+from .api import SierraApi_v2
+
+
+BIB_FIELDS = 'id,author,materialType,lang,createdDate'
+
+
+class BibRecord(namedtuple('BibRecord', 'id author format_code language_code created_at')):
+    """
+    The parts of a new bib that autoholds uses: its record number, author, format (material type) code, language code
+    and when it was created.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def from_api_entry(entry):
+        """Return the BibRecord for a bib returned by the Sierra API with BIB_FIELDS."""
+        return BibRecord(
+            int(entry['id']),
+            entry.get('author') or '',
+            entry['materialType']['code'],
+            entry['lang']['code'],
+            SierraApi_v2.parse_datetime(entry['createdDate'])
+        )
+
+
+class ApiBibSource:
+    """
+    Discovers new bibs through the Sierra API.
+
+    new_bibs yields the bibs as the Sierra API returns them, and bib_record turns each one into a BibRecord. Every
+    discovery source works this way, so that a bib that can't be read can be reported without stopping discovery.
+    """
+
+    name = 'api'
+    filtered = False
+
+    def __init__(self, sierra_api):
+        self.sierra_api = sierra_api
+
+    def new_bibs(self, created_date_from, created_date_to):
+        return self.sierra_api.bibs_iter(
+            created_date={'range_from': created_date_from, 'range_to': created_date_to},
+            fields=BIB_FIELDS,
+            deleted=False,
+            suppressed=False
+        )
+
+    @staticmethod
+    def bib_record(entry):
+        return BibRecord.from_api_entry(entry)
+
+
+class SqlBibSource:
+    """
+    Discovers new bibs by querying Sierra's database directly.
+
+    The bibs are streamed through a server-side cursor, itersize rows at a time.
+    """
+
+    name = 'sql'
+    filtered = False
+
+    NEW_BIBS_SQL = (
+        'SELECT rm.record_num, rm.creation_date_gmt, p.best_author, b.bcode2, b.language_code '
+        'FROM record_metadata AS rm '
+        'JOIN bib_record AS b ON b.id = rm.id '
+        'JOIN bib_record_property AS p ON p.bib_record_id = b.id '
+        'WHERE rm.record_type_code = %s '
+        'AND rm.campus_code = %s '
+        'AND rm.deletion_date_gmt IS NULL '
+        'AND NOT b.is_suppressed '
+        'AND rm.creation_date_gmt >= %s '
+        'AND rm.creation_date_gmt <= %s '
+        'ORDER BY rm.record_num'
+    )
+
+    def __init__(self, using='sierra', itersize=2000):
+        self.using = using
+        self.itersize = itersize
+
+    def new_bibs(self, created_date_from, created_date_to):
+        return self._query(self.NEW_BIBS_SQL, ['b', '', created_date_from, created_date_to])
+
+    def _query(self, sql, params):
+        connection = connections[self.using]
+        with transaction.atomic(using=self.using):
+            connection.ensure_connection()
+            # Django's cursors are client-side, so use a named (server-side) psycopg2 cursor directly.
+            with connection.connection.cursor(name='autoholds_new_bibs') as cursor:
+                cursor.itersize = self.itersize
+                cursor.execute(sql, params)
+                yield from cursor
+
+    @staticmethod
+    def bib_record(row):
+        record_num, creation_date_gmt, best_author, bcode2, language_code = row
+        if creation_date_gmt.tzinfo is None:
+            creation_date_gmt = creation_date_gmt.replace(tzinfo=timezone.utc)
+        return BibRecord(
+            int(record_num),
+            best_author or '',
+            (bcode2 or '').strip(),
+            (language_code or '').strip(),
+            creation_date_gmt
+        )
+
+
+def _accented_letters():
+    # Returns the lower case Latin letters with diacritics, and the same letters without them, for translate().
+    letters, unaccented_letters = '', ''
+    for letter in map(chr, range(0xc0, 0x250)):
+        unaccented = ''.join(x for x in unicodedata.normalize('NFKD', letter) if not unicodedata.combining(x))
+        if letter.islower() and len(unaccented) == 1 and 'a' <= unaccented <= 'z':
+            letters += letter
+            unaccented_letters += unaccented
+    return letters, unaccented_letters
+
+
+class RegisteredSqlBibSource(SqlBibSource):
+    """
+    Discovers only the new bibs that could match a registration, by querying Sierra's database directly.
+
+    Only the bibs whose (first word of the author, format code, language code) is one of registration_keys are
+    returned. The first word of a bib's author is taken after lower casing it and removing the diacritics from Latin
+    letters, like the first word of patron.models.normalize_author. Matching on only the first word lets through
+    the bibs whose authors differ from a registration's only in their life dates, relator terms or punctuation, and
+    some that don't match at all, so the bibs must still be matched on their normalised authors.
+    """
+
+    name = 'sql-registered'
+    filtered = True
+
+    NEW_BIBS_SQL = (
+        'SELECT rm.record_num, rm.creation_date_gmt, p.best_author, b.bcode2, b.language_code '
+        'FROM record_metadata AS rm '
+        'JOIN bib_record AS b ON b.id = rm.id '
+        'JOIN bib_record_property AS p ON p.bib_record_id = b.id '
+        'JOIN unnest(%s::text[], %s::text[], %s::text[]) AS r (author, format_code, language_code) '
+        'ON r.author = substring(translate(lower(p.best_author), %s, %s) from \'[[:alnum:]]+\') '
+        'AND r.format_code = b.bcode2::text '
+        'AND r.language_code = b.language_code::text '
+        'WHERE rm.record_type_code = %s '
+        'AND rm.campus_code = %s '
+        'AND rm.deletion_date_gmt IS NULL '
+        'AND NOT b.is_suppressed '
+        'AND rm.creation_date_gmt >= %s '
+        'AND rm.creation_date_gmt <= %s '
+        'ORDER BY rm.record_num'
+    )
+
+    ACCENTED_LETTERS, UNACCENTED_LETTERS = _accented_letters()
+
+    def __init__(self, registration_keys, using='sierra', itersize=2000):
+        super().__init__(using, itersize)
+        self.registration_keys = list(registration_keys)
+
+    def new_bibs(self, created_date_from, created_date_to):
+        if not self.registration_keys:
+            return iter(())
+        authors, format_codes, language_codes = (list(x) for x in zip(*self.registration_keys))
+        return self._query(
+            self.NEW_BIBS_SQL,
+            [
+                authors, format_codes, language_codes, self.ACCENTED_LETTERS, self.UNACCENTED_LETTERS,
+                'b', '', created_date_from, created_date_to
+            ]
+        )
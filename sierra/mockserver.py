@@ -0,0 +1,362 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A stand-in for the Sierra API, for load and regression testing AutoHolds without touching a real Sierra.
+
+It implements only what AutoHolds uses: /v2/token, /v2/bibs, /v2/bibs/{id}, /v2/patrons/find and
+/v2/patrons/{id}/holds/requests. The catalogue is synthetic and isn't stored: each bib is generated from its record
+number and the seed, so the same settings always give the same catalogue, of any size. Latency and error rates can be
+configured to see how AutoHolds copes with a slow or failing Sierra.
+
+Run it with the mock_sierra management command, or with MockSierraServer(...).serve_forever().
+"""
+
+from base64 import b64decode
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+import re
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+
+SURNAMES = (
+    'Adams', 'Baker', 'Chen', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Ito', 'Jones', 'Kowalski', 'Lopez',
+    'Martin', 'Nguyen', 'OBrien', 'Patel', 'Quinn', 'Rossi', 'Smith', 'Tanaka', 'Ueda', 'Varga', 'Walker', 'Young',
+)
+GIVEN_NAMES = (
+    'Alice', 'Ben', 'Chloe', 'David', 'Emma', 'Frank', 'Grace', 'Hiro', 'Isla', 'Jack', 'Kate', 'Liam', 'Mia', 'Noah',
+)
+
+
+class MockCatalogue:
+    """
+    num_bibs synthetic bibs, numbered from first_bib_record_number, created at evenly spaced times over the days
+    before created_until.
+
+    Each bib's author, format and language are picked at random from num_authors synthetic authors, format_codes
+    and language_codes. A registered_share of the bibs instead get an (author, format code, language code) picked
+    from registered_keys, so that they match registrations and holds get placed on them.
+    """
+
+    def __init__(self, *, num_bibs=100000, first_bib_record_number=1000000, days=30, created_until=None,
+                 num_authors=10000, format_codes=('a',), language_codes=('eng',), registered_keys=(),
+                 registered_share=0.0, seed=0):
+        self.num_bibs = num_bibs
+        self.first_bib_record_number = first_bib_record_number
+        self.created_until = (created_until or datetime.now(timezone.utc)).replace(microsecond=0)
+        self.created_from = self.created_until - timedelta(days=days)
+        self.interval = (self.created_until - self.created_from) / max(num_bibs, 1)
+        self.num_authors = num_authors
+        self.format_codes = list(format_codes)
+        self.language_codes = list(language_codes)
+        self.registered_keys = list(registered_keys)
+        self.registered_share = registered_share if self.registered_keys else 0.0
+        self.seed = seed
+
+    def __len__(self):
+        return self.num_bibs
+
+    def author(self, n):
+        surname = SURNAMES[n % len(SURNAMES)]
+        given_name = GIVEN_NAMES[(n // len(SURNAMES)) % len(GIVEN_NAMES)]
+        return '{}{}, {}'.format(surname, n // (len(SURNAMES) * len(GIVEN_NAMES)) or '', given_name)
+
+    def bib(self, i):
+        """Return the i-th bib, as the Sierra API would return it with every field that AutoHolds uses."""
+        rng = random.Random(self.seed * 1000003 + i)
+        if rng.random() < self.registered_share:
+            author, format_code, language_code = rng.choice(self.registered_keys)
+        else:
+            author = self.author(rng.randrange(self.num_authors))
+            format_code = rng.choice(self.format_codes)
+            language_code = rng.choice(self.language_codes)
+        return {
+            'id': str(self.first_bib_record_number + i),
+            'author': author,
+            'materialType': {'code': format_code, 'value': format_code},
+            'lang': {'code': language_code, 'name': language_code},
+            'createdDate': self.created_at(i).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'deleted': False,
+            'suppressed': False,
+        }
+
+    def created_at(self, i):
+        return (self.created_from + self.interval * i).replace(microsecond=0)
+
+    def index_of(self, bib_record_number):
+        i = int(bib_record_number) - self.first_bib_record_number
+        return i if 0 <= i < self.num_bibs else None
+
+    def created_range(self, created_from=None, created_to=None):
+        """Return the range of the indexes of the bibs created from created_from to created_to, inclusive."""
+        created_ats = _CreatedAts(self)
+        start = 0 if created_from is None else bisect_left(created_ats, created_from)
+        stop = self.num_bibs if created_to is None else bisect_right(created_ats, created_to)
+        return range(start, max(start, stop))
+
+
+class _CreatedAts:
+    # A read-only sequence of the catalogue's creation times, so that they can be bisected without being stored.
+
+    def __init__(self, catalogue):
+        self.catalogue = catalogue
+
+    def __len__(self):
+        return len(self.catalogue)
+
+    def __getitem__(self, i):
+        return self.catalogue.created_at(i)
+
+
+class MockSierra:
+    """
+    The state and behaviour of the mock Sierra API, separate from HTTP so that it can also be driven directly.
+
+    Every request waits latency seconds, plus up to latency_jitter more. A share of requests, error_rate, fails as
+    if Sierra were briefly unavailable (503), and is counted in num_errors. A share of hold requests, hold_denied_rate,
+    is refused with an XCirc error as if the patron were blocked. A second hold on the same bib for the same patron is
+    always refused. Pages of bibs are never longer than max_page_size.
+    """
+
+    XCIRC_ERROR_CODE = 132
+    PATRON_BLOCKED_SPECIFIC_CODE = 2
+    ALREADY_REQUESTED_SPECIFIC_CODE = 929
+
+    def __init__(self, catalogue, *, client_key='key', client_secret='secret', token_lifetime=3600, latency=0.0,
+                 latency_jitter=0.0, error_rate=0.0, hold_denied_rate=0.0, max_page_size=2000, pickup_location='a',
+                 language_code='eng', seed=0):
+        self.catalogue = catalogue
+        self.client_key = client_key
+        self.client_secret = client_secret
+        self.token_lifetime = token_lifetime
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.hold_denied_rate = hold_denied_rate
+        self.max_page_size = max_page_size
+        self.pickup_location = pickup_location
+        self.language_code = language_code
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._access_tokens = dict()
+        self.holds = dict()
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def handle(self, method, path, params, authorization, body):
+        """Handle one request, and return its (HTTP status, JSON-able response)."""
+        with self._lock:
+            self.num_requests += 1
+            delay = self.latency + self._random.uniform(0, self.latency_jitter)
+            fail = self._random.random() < self.error_rate
+            deny = self._random.random() < self.hold_denied_rate
+        if delay > 0:
+            time.sleep(delay)
+        match = re.search(r'/v2/(.*?)/?$', path)
+        route = match.group(1) if match else ''
+        if method == 'POST' and route == 'token':
+            return self._token(authorization)
+        if not self._is_authorized(authorization):
+            return self._error(401, 123, 0, 'Unauthorized', 'invalid_grant')
+        if fail:
+            with self._lock:
+                self.num_errors += 1
+            return self._error(503, 109, 0, 'Service Unavailable', 'Mock Sierra is unavailable, as configured')
+        if method == 'GET' and route == 'bibs':
+            return self._bibs(params)
+        match = re.match(r'bibs/(\d+)$', route)
+        if method == 'GET' and match:
+            return self._bib(match.group(1), params)
+        if method == 'GET' and route == 'patrons/find':
+            return self._patrons_find(params)
+        match = re.match(r'patrons/(\d+)/holds/requests$', route)
+        if method == 'POST' and match:
+            return self._place_hold(int(match.group(1)), body, deny)
+        return self._error(404, 107, 0, 'Record not found')
+
+    @staticmethod
+    def _error(http_status, code, specific_code, name, description=None):
+        error = {'code': code, 'specificCode': specific_code, 'httpStatus': http_status, 'name': name}
+        if description:
+            error['description'] = description
+        return http_status, error
+
+    def _token(self, authorization):
+        try:
+            scheme, credentials = authorization.split(' ', 1)
+            client_key, client_secret = b64decode(credentials).decode().split(':', 1)
+        except ValueError:
+            return self._error(401, 123, 0, 'Unauthorized', 'invalid_client')
+        if scheme != 'Basic' or (client_key, client_secret) != (self.client_key, self.client_secret):
+            return self._error(401, 123, 0, 'Unauthorized', 'invalid_client')
+        access_token = uuid.uuid4().hex
+        with self._lock:
+            self._access_tokens[access_token] = time.time() + self.token_lifetime
+        return 200, {'access_token': access_token, 'token_type': 'bearer', 'expires_in': self.token_lifetime}
+
+    def _is_authorized(self, authorization):
+        if not authorization or not authorization.startswith('Bearer '):
+            return False
+        with self._lock:
+            expires_at = self._access_tokens.get(authorization[len('Bearer '):])
+        return expires_at is not None and time.time() < expires_at
+
+    @staticmethod
+    def _param(params, name, default=None):
+        values = params.get(name)
+        return values[0] if values else default
+
+    @staticmethod
+    def _parse_date(value):
+        if not value:
+            return None
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def _with_fields(bib, fields):
+        if not fields:
+            return bib
+        wanted = set(fields.split(',')) | {'id'}
+        return {k: v for k, v in bib.items() if k in wanted}
+
+    def _bibs(self, params):
+        catalogue = self.catalogue
+        limit = min(int(self._param(params, 'limit', 50)), self.max_page_size)
+        offset = int(self._param(params, 'offset', 0))
+        fields = self._param(params, 'fields')
+        ids = self._param(params, 'id')
+        if ids:
+            indexes = (catalogue.index_of(x) for x in ids.split(','))
+            indexes = [x for x in indexes if x is not None]
+        else:
+            created_from, created_to = None, None
+            created_date = self._param(params, 'createdDate')
+            if created_date:
+                match = re.match(r'\[(.*),(.*)\]$', created_date)
+                if match is None:
+                    created_from = created_to = self._parse_date(created_date)
+                else:
+                    created_from, created_to = (self._parse_date(x) for x in match.groups())
+            indexes = catalogue.created_range(created_from, created_to)
+        indexes = indexes[offset:offset + limit]
+        if not indexes:
+            return self._error(404, 107, 0, 'Record not found')
+        entries = [self._with_fields(catalogue.bib(i), fields) for i in indexes]
+        return 200, {'total': len(entries), 'start': offset, 'entries': entries}
+
+    def _bib(self, bib_record_number, params):
+        i = self.catalogue.index_of(bib_record_number)
+        if i is None:
+            return self._error(404, 107, 0, 'Record not found')
+        return 200, self._with_fields(self.catalogue.bib(i), self._param(params, 'fields'))
+
+    def _patrons_find(self, params):
+        # Every all-digit barcode belongs to a patron, whose record number is derived from the barcode.
+        barcode = self._param(params, 'barcode', '')
+        if not barcode.isdigit():
+            return self._error(404, 107, 0, 'Record not found')
+        patron_record_number = 1000000 + int(barcode) % 9000000
+        return 200, {
+            'id': patron_record_number,
+            'names': ['PATRON, MOCK {}'.format(patron_record_number)],
+            'fixedFields': {
+                '53': {'label': 'Home Library', 'value': self.pickup_location},
+                '263': {'label': 'Language Preference', 'value': self.language_code},
+            },
+        }
+
+    def _place_hold(self, patron_record_number, body, deny):
+        try:
+            hold = json.loads(body.decode() if body else '{}')
+            key = (patron_record_number, hold['recordType'], int(hold['recordNumber']))
+            pickup_location = hold['pickupLocation']
+        except (KeyError, TypeError, ValueError):
+            return self._error(400, 130, 0, 'Invalid JSON')
+        if deny:
+            return self._error(
+                500, self.XCIRC_ERROR_CODE, self.PATRON_BLOCKED_SPECIFIC_CODE, 'XCirc error',
+                'XCirc error : You may not make requests. Please consult Circulation staff for assistance.'
+            )
+        with self._lock:
+            if key in self.holds:
+                already_requested = True
+            else:
+                already_requested = False
+                self.holds[key] = pickup_location
+        if already_requested:
+            return self._error(
+                500, self.XCIRC_ERROR_CODE, self.ALREADY_REQUESTED_SPECIFIC_CODE, 'XCirc error',
+                'XCirc error : Request denied - already requested'
+            )
+        return 200, None
+
+
+class _MockSierraRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, result = self.server.mock_sierra.handle(
+            self.command, url.path, parse_qs(url.query), self.headers.get('Authorization'), body
+        )
+        content = b'' if result is None else json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        if content and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            content = gzip.compress(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MockSierraServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server for a MockSierra, handling each connection on its own thread, with keep-alive."""
+
+    daemon_threads = True
+
+    def __init__(self, mock_sierra, host='127.0.0.1', port=8800, verbose=False):
+        super().__init__((host, port), _MockSierraRequestHandler)
+        self.mock_sierra = mock_sierra
+        self.verbose = verbose
+
+    @property
+    def base_url(self):
+        """The base_url to give SierraApiSettings to use this server."""
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/iii/sierra-api'.format(host, port)
@@ -15,6 +15,68 @@
 # You should have received a copy of the GNU General Public License
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+import gzip
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .api import SierraApi_v2, TokenBucket, _decoded_chunks, _iter_json_entries
+
+
+class IterJsonEntriesTests(SimpleTestCase):
+
+    ENTRIES = [
+        {'id': '1000001', 'author': 'Smith, John', 'createdDate': '2016-05-23T00:58:00Z'},
+        {'id': '1000002', 'author': 'Brackets ] and, commas [', 'createdDate': '2016-05-23T00:59:00Z'},
+        {'id': '1000003', 'author': 'Bront\u00eb, Charlotte', 'createdDate': '2016-05-23T01:00:00Z'},
+    ]
+
+    def _body(self, entries):
+        return json.dumps({'total': len(entries), 'start': 0, 'entries': entries}).encode()
+
+    def test_decodes_the_entries_however_the_body_is_split(self):
+        body = self._body(self.ENTRIES)
+        for chunk_size in (1, 2, 7, 64, len(body)):
+            with self.subTest(chunk_size=chunk_size):
+                chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+                self.assertEqual(list(_iter_json_entries(chunks)), self.ENTRIES)
+
+    def test_decodes_a_compressed_body(self):
+        body = gzip.compress(self._body(self.ENTRIES))
+        self.assertEqual(list(_iter_json_entries(_decoded_chunks(body, 'gzip', 16))), self.ENTRIES)
+
+    def test_an_empty_result_set_has_no_entries(self):
+        self.assertEqual(list(_iter_json_entries([self._body([])])), [])
+
+    def test_a_truncated_result_set_is_an_error(self):
+        body = self._body(self.ENTRIES)
+        entries = _iter_json_entries([body[:len(body) // 2]])
+        with self.assertRaises(ValueError):
+            list(entries)
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    @mock.patch('sierra.api.time.monotonic')
+    def test_reserve_says_how_long_to_wait_once_the_burst_is_used_up(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(10, 2)
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.1, 0.2])
+        # Half a second later, the debt of two tokens has been repaid and three more tokens have been added.
+        monotonic.return_value = 100.5
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0.1])
+
+    @mock.patch('sierra.api.time.monotonic')
+    def test_the_bucket_never_holds_more_than_its_capacity(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(10, 2)
+        monotonic.return_value = 200.0
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0.1])
+
+
+class BibsParamsTests(SimpleTestCase):
+
+    def test_booleans_are_sent_in_lower_case(self):
+        params = SierraApi_v2._bibs_params(None, 10, None, 'id', None, False, True)
+        self.assertEqual(params, {'limit': 10, 'fields': 'id', 'deleted': 'false', 'suppressed': 'true'})
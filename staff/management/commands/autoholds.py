@@ -16,59 +16,279 @@
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from functools import partial
+import signal
 import sys
+import threading
 import traceback
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
 from django.utils.timezone import localtime, now
 
-from patron.models import Registration
+from patron.models import RegistrationIndex
 from sierra.api import SierraApi_v2, SierraApiError
-from ...models import BibLog, HoldLog, RunLog
+from sierra.discovery import BIB_FIELDS, ApiBibSource, BibRecord, RegisteredSqlBibSource, SqlBibSource
+from ...models import BibLog, DiscoveryCheckpoint, HoldJob, HoldLedger, HoldLog, LogWriter, RunLog
 
 
 class Command(BaseCommand):
 
-    MAXIMUM_BATCHES_PER_RUN = 10
+    RETRY_BATCH_SIZE = 50
 
     help = 'Discover new bib records and place auto-holds on them'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sierra_api = None
+        self.bib_source = None
+        self.checkpoint = None
+        self.save_checkpoint = True
+        self.registration_index = None
+        self.log_all_bibs = False
+        self.enqueue_holds = False
+        self.hold_executor = None
+        self.async_sierra_api = None
+        self.event_loop = None
+        # The logs are only written along with the checkpoint and the hold queue orders, by _write_logs_and_checkpoint.
+        self.log_writer = LogWriter(auto_flush=False)
+        self.stopping = threading.Event()
+        self.deadline = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--discovery', choices=['api', 'sql', 'sql-registered'], default='api',
+            help=(
+                'Discover new bibs through the Sierra API, by querying the Sierra database directly, or by querying '
+                'the Sierra database for only the bibs whose format, language and first word of the author match a '
+                'registration. Every mode matches the bibs it finds to registrations in the same way (default: api)'
+            )
+        )
+        parser.add_argument(
+            '--hold-workers', type=int, default=1, metavar='N',
+            help='Place up to N holds for a bib concurrently (default: 1, one hold at a time)'
+        )
+        parser.add_argument(
+            '--async-holds', action='store_true',
+            help=(
+                'Place the holds for a bib concurrently on an asyncio event loop, rather than on --hold-workers '
+                'threads. Cannot be used with --hold-workers. Needs Python 3.5 or later and aiohttp.'
+            )
+        )
+        parser.add_argument(
+            '--max-concurrency', type=int, default=100, metavar='N',
+            help='With --async-holds, have up to N requests to the Sierra API in flight at once (default: 100)'
+        )
+        parser.add_argument(
+            '--enqueue-holds', action='store_true',
+            help='Queue the holds to be placed by the holdworker command, rather than placing them straight away'
+        )
+        parser.add_argument(
+            '--log-all-bibs', action='store_true',
+            help='Log every new bib, rather than only counting the ones that match no registration'
+        )
+        parser.add_argument(
+            '--max-run-log-notes', type=int, default=None, metavar='N',
+            help='Keep at most N notes in the run log, and only summarise the rest (default: keep them all)'
+        )
+        parser.add_argument(
+            '--time-budget', type=float, default=None, metavar='SECONDS',
+            help=(
+                'Stop processing new bibs once the run has taken this long, even partway through a batch. The next '
+                'run resumes from where this one stopped (default: no limit)'
+            )
+        )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running, polling for new bibs, until sent SIGTERM or SIGINT. Each poll gets its own run log.'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=60, metavar='SECONDS',
+            help='With --daemon, wait this long between polls while new bibs are being found (default: 60)'
+        )
+        parser.add_argument(
+            '--max-poll-interval', type=float, default=900, metavar='SECONDS',
+            help=(
+                'With --daemon, double the wait after each poll that finds no new bibs, up to this long '
+                '(default: 900)'
+            )
+        )
 
     def handle(self, *args, **options):
+        self.log_all_bibs = options['log_all_bibs']
+        self.enqueue_holds = options['enqueue_holds']
+        if options['async_holds'] and options['hold_workers'] > 1:
+            raise CommandError('--async-holds and --hold-workers cannot be used together')
+        if options['async_holds']:
+            self._start_async_api(options['max_concurrency'])
+        elif options['hold_workers'] > 1:
+            self.hold_executor = ThreadPoolExecutor(max_workers=options['hold_workers'])
+        try:
+            if options['daemon']:
+                self._run_daemon(options)
+            else:
+                self._run(options)
+        finally:
+            if self.hold_executor is not None:
+                self.hold_executor.shutdown()
+            if self.event_loop is not None:
+                self.event_loop.run_until_complete(self.async_sierra_api.close())
+                self.event_loop.close()
+
+    def _start_async_api(self, max_concurrency):
+        try:
+            from sierra.async_api import AsyncSierraApi_v2
+            self.async_sierra_api = AsyncSierraApi_v2.from_settings(
+                settings.SIERRA_API, max_concurrency=max_concurrency
+            )
+        except (ImportError, SyntaxError) as e:
+            raise CommandError('--async-holds cannot be used: {}'.format(e))
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+
+    def _run_daemon(self, options):
+        #
+        # Poll again soon while new bibs are turning up, and back off while they're not.
+        #
+        def _stop(signum, frame):
+            self.stdout.write('Stopping after the current poll', style_func=self.style.NOTICE)
+            self.stopping.set()
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+        interval = options['poll_interval']
+        while not self.stopping.is_set():
+            try:
+                run_log, num_new_bibs = self._run(options)
+            except Exception as e:
+                # Most likely the autoholds database is unavailable, so the error couldn't be logged in a run log.
+                self.stdout.write('An error occurred while autoholds was running: {}'.format(e),
+                                  style_func=self.style.ERROR)
+                num_new_bibs = 0
+            if num_new_bibs > 0:
+                interval = options['poll_interval']
+            else:
+                interval = min(interval * 2, options['max_poll_interval'])
+            self._close_unusable_connections()
+            self.stopping.wait(interval)
+
+    def _run(self, options, created_until=None):
+        #
+        # Process the bibs created from the checkpoint up until created_until, or the start of the run.
+        # Returns the run log and the number of new bibs processed.
+        #
         run_log = RunLog(started_at=now())
+        run_log.max_log_notes = options['max_run_log_notes']
+        run_log.time_budget = options.get('time_budget')
         run_log.save()
+        if created_until is None:
+            created_until = run_log.started_at
+        if run_log.time_budget is None:
+            self.deadline = None
+        else:
+            self.deadline = run_log.started_at + timedelta(seconds=run_log.time_budget)
+        num_new_bibs_in_run = 0
+        discovery_started_at = None
         try:
             self.stdout.write('This run will be recorded into run log id {}'.format(run_log.id))
-            self.sierra_api = SierraApi_v2.login(
-                settings.SIERRA_API.base_url,
-                settings.SIERRA_API.client_key,
-                settings.SIERRA_API.client_secret
+            if self.sierra_api is None:
+                self.sierra_api = SierraApi_v2.from_settings(settings.SIERRA_API)
+                if options['hold_workers'] > 1:
+                    self.sierra_api.set_pool_size(options['hold_workers'])
+            if not self.enqueue_holds:
+                self._retry_failed_holds(run_log)
+            self.registration_index = RegistrationIndex.load()
+            self._log_info(
+                run_log,
+                'Loaded the registrations for {} author, format and language combinations',
+                len(self.registration_index)
             )
-            last_bib_record_number, last_bib_created_at = self._last_bib_seen()
+            self.bib_source = self._new_bib_source(options['discovery'])
+            if self.checkpoint is None:
+                self.checkpoint = self._load_checkpoint()
             self._log_info(
                 run_log,
                 'The last bib that was seen in previous runs was .b{}a, created at {}.',
-                last_bib_record_number, localtime(last_bib_created_at)
+                self.checkpoint.last_bib_record_number, localtime(self.checkpoint.last_bib_created_at)
             )
-            num_batches = 0
-            num_bibs_found = 1  # Force at-least one iteration of the following loop
-            while num_bibs_found > 0 and num_batches < self.MAXIMUM_BATCHES_PER_RUN:
-                num_batches += 1
-                num_bibs_found, last_bib_created_at, last_bib_record_number = (
-                    self._process_batch(last_bib_created_at, last_bib_record_number, run_log)
-                )
+            #
+            # Keep taking batches until there are no new bibs left, or, if the run has a time budget, until a batch
+            # stops partway through because the budget has run out. A batch that only finds bibs that were already
+            # processed doesn't use up the budget, so the batch after the last new bib is still taken, to find out
+            # whether any new bibs are left.
+            #
+            discovery_started_at = now()
+            num_new_bibs = 1  # Force at-least one iteration of the following loop
+            while num_new_bibs > 0 and not run_log.time_budget_exhausted and not self.stopping.is_set():
+                run_log.num_batches += 1
+                num_new_bibs = self._process_batch(run_log, created_until)
+                num_new_bibs_in_run += num_new_bibs
+                self._write_logs_and_checkpoint()
         except Exception as e:
             self._log_error(run_log, 'An error occurred while autoholds was running: {}', e)
             self._log_exception_details(run_log, sys.exc_info())
         else:
             run_log.successful = True
         finally:
+            try:
+                self._write_logs_and_checkpoint()
+            except Exception as e:
+                self._log_error(run_log, 'An error occurred while writing the bib and hold logs: {}', e)
+                self._log_exception_details(run_log, sys.exc_info())
+                run_log.successful = False
             run_log.ended_at = now()
+            if discovery_started_at is not None:
+                discovery_seconds = (run_log.ended_at - discovery_started_at).total_seconds()
+                if discovery_seconds > 0:
+                    run_log.bibs_per_second = run_log.num_bibs_found / discovery_seconds
             run_log.save()
+        return run_log, num_new_bibs_in_run
+
+    def _new_bib_source(self, discovery):
+        if discovery == 'sql-registered':
+            return RegisteredSqlBibSource(self.registration_index.author_first_word_keys())
+        elif discovery == 'sql':
+            return SqlBibSource()
+        else:
+            return ApiBibSource(self.sierra_api)
+
+    def _out_of_time(self):
+        # Whether the run's time budget has run out.
+        return self.deadline is not None and now() >= self.deadline
+
+    @staticmethod
+    def _close_unusable_connections():
+        # Keep the database connections open between polls, unless they've stopped working.
+        for connection in connections.all():
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+
+    def _load_checkpoint(self):
+        #
+        # Resume from where the last run using the same discovery source left off. If this discovery source hasn't
+        # been used before, resume from where the most recent run using any discovery source left off.
+        #
+        checkpoint = DiscoveryCheckpoint.objects.filter(source=self.bib_source.name).first()
+        if checkpoint is None:
+            checkpoint = DiscoveryCheckpoint(source=self.bib_source.name)
+            latest_checkpoint = DiscoveryCheckpoint.objects.order_by('-updated_at').first()
+            if latest_checkpoint is not None:
+                checkpoint.last_bib_record_number = latest_checkpoint.last_bib_record_number
+                checkpoint.last_bib_created_at = latest_checkpoint.last_bib_created_at
+            else:
+                checkpoint.last_bib_record_number, checkpoint.last_bib_created_at = self._last_bib_seen()
+        return checkpoint
+
+    def _write_logs_and_checkpoint(self):
+        with transaction.atomic():
+            self.log_writer.flush()
+            if self.registration_index is not None:
+                self.registration_index.save_hold_queue_orders()
+            if self.checkpoint is not None and self.save_checkpoint:
+                self.checkpoint.save()
 
     def _last_bib_seen(self):
         #
@@ -100,37 +320,65 @@ class Command(BaseCommand):
         #
         return last_bib_record_number, last_bib_created_at
 
-    def _process_batch(self, last_bib_created_at, last_bib_record_number, run_log):
-        new_bibs = self._get_new_bibs(last_bib_created_at, run_log.started_at)
-        num_bibs_found = len(new_bibs)
-        run_log.num_bibs_found += num_bibs_found
-        self._log_info(
-            run_log,
-            'Found {} new bib records created since {}',
-            num_bibs_found, localtime(last_bib_created_at)
-        )
-        for bib in new_bibs:
+    def _process_batch(self, run_log, created_until):
+        checkpoint = self.checkpoint
+        created_since = checkpoint.last_bib_created_at
+        num_unmatched_before = run_log.num_bibs_unmatched
+        num_bibs_found = 0
+        num_new_bibs = 0
+        stopped_early = False
+        bibs = self._get_new_bibs(created_since, created_until)
+        for found_bib in bibs:
+            #
+            # Between bibs, the checkpoint covers exactly the bibs that have been logged, so this is where a full log
+            # writer is written, together with the checkpoint and the hold queue orders.
+            #
+            if self.log_writer.is_full():
+                self._write_logs_and_checkpoint()
+            #
+            # The bibs come in order, and the checkpoint moves past each one as it is processed, so the run can stop
+            # between any two bibs and the next run will resume from there.
+            #
+            if self.stopping.is_set():
+                self._log_notice(run_log, 'Stopping partway through the batch, because autoholds was asked to stop')
+                stopped_early = True
+                break
+            num_bibs_found += 1
             try:
-                bib_record_number = int(bib['id'])
-            except ValueError as e:
+                bib = self.bib_source.bib_record(found_bib)
+            except (KeyError, TypeError, ValueError) as e:
                 self._log_error(
                     run_log,
-                    'Failed to convert bib id {} to an integer: {}',
-                    bib.get('id', '?'), e
+                    'Failed to read bib {!r}: {}',
+                    found_bib, e
                 )
                 self._log_exception_details(run_log, sys.exc_info())
                 continue
-            if bib_record_number <= last_bib_record_number:
+            bib_record_number = bib.id
+            if bib_record_number <= checkpoint.last_bib_record_number:
                 self._log_notice(
                     run_log,
                     'Skipping .b{}a because it has already seen during a previous run',
                     bib_record_number
                 )
                 continue
-            else:
-                last_bib_record_number = bib_record_number
+            #
+            # The time budget has only run out if it leaves a new bib unprocessed, so this is checked once the bib is
+            # known to be new. The bib is found again by the next run.
+            #
+            if self._out_of_time():
+                self._log_notice(
+                    run_log,
+                    'Stopping partway through the batch, because the time budget of {} seconds has run out',
+                    run_log.time_budget
+                )
+                run_log.time_budget_exhausted = True
+                stopped_early = True
+                break
+            checkpoint.last_bib_record_number = bib_record_number
+            num_new_bibs += 1
             try:
-                bib_created_at = self._process_bib(bib, bib_record_number, run_log)
+                self._process_bib(bib, run_log)
             except Exception as e:
                 self._log_error(
                     run_log,
@@ -139,56 +387,64 @@ class Command(BaseCommand):
                 )
                 self._log_exception_details(run_log, sys.exc_info())
                 continue
-            if bib_created_at is not None and bib_created_at > last_bib_created_at:
-                last_bib_created_at = bib_created_at
-        return num_bibs_found, last_bib_created_at, last_bib_record_number
+            if bib.created_at > checkpoint.last_bib_created_at:
+                checkpoint.last_bib_created_at = bib.created_at
+        # Stopping partway through leaves the discovery source's query open, so close it.
+        close = getattr(bibs, 'close', None)
+        if close is not None:
+            close()
+        #
+        # A filtered discovery source doesn't return the bibs that it filtered out, so the last bib it returned can
+        # be long before the end of the batch. Having seen every bib it would return up to the end of the batch, we
+        # can resume from the end of the batch.
+        #
+        if self.bib_source.filtered and not stopped_early and created_until > checkpoint.last_bib_created_at:
+            checkpoint.last_bib_created_at = created_until
+        run_log.num_bibs_found += num_bibs_found
+        self._log_info(
+            run_log,
+            'Found {} bib records ({} new) created since {}. {} new bib records matched no registration.',
+            num_bibs_found, num_new_bibs, localtime(created_since), run_log.num_bibs_unmatched - num_unmatched_before
+        )
+        return num_new_bibs
 
-    def _process_bib(self, bib, bib_record_number, run_log):
+    def _process_bib(self, bib, run_log):
+        bib_record_number = bib.id
+        #
+        # Most bibs don't match any registration. Unless every bib is to be logged, just count those ones.
+        #
+        matched = bool(bib.author) and self.registration_index.matches(bib.author, bib.format_code, bib.language_code)
+        if not matched and not self.log_all_bibs:
+            run_log.num_bibs_unmatched += 1
+            return
         bib_log = BibLog(
             run_log=run_log,
             bib_record_number=bib_record_number,
-            bib_created_at=self.sierra_api.parse_datetime(bib['createdDate']),
-            author=bib['author'],
-            format=bib['materialType']['code'],
-            language=bib['lang']['code']
+            bib_created_at=bib.created_at,
+            author=bib.author,
+            format=bib.format_code,
+            language=bib.language_code
         )
-        bib_log.save()
         try:
             if bib_log.author:
-                regs = (
-                    Registration.objects.filter(
-                        author__name__iexact=bib_log.author,
-                        format__code=bib_log.format,
-                        format__active=True,
-                        language__code=bib_log.language,
-                        language__active=True
-                    )
-                    .order_by('hold_queue_order')
-                )
+                regs = self.registration_index.find(bib_log.author, bib_log.format, bib_log.language)
                 bib_log.num_registrations_found = len(regs)
                 self._log_info(
                     bib_log,
                     'Found {} registrations for .b{}a, format {} and language {}',
                     bib_log.num_registrations_found, bib_record_number, bib_log.format, bib_log.language
                 )
-                for reg in regs:
-                    try:
-                        self._place_hold(bib_record_number, reg, bib_log)
-                    except Exception as e:
-                        self._log_error(
-                            bib_log,
-                            'An error occurred while processing registration id {} for .b{}a: {}',
-                            reg.id, bib_record_number, e
-                        )
-                        self._log_exception_details(bib_log, sys.exc_info())
+                if self.enqueue_holds:
+                    self._enqueue_holds(bib_record_number, regs, bib_log)
+                else:
+                    self._place_holds(bib_record_number, regs, bib_log)
                 if len(regs) > 1:
                     first_reg = regs[0]
-                    first_reg.move_to_last_in_hold_queue_order()
+                    self.registration_index.move_to_last_in_hold_queue_order(first_reg)
                     self._log_info(
                         bib_log,
-                        'Moved .p{}a to bottom of queue for .b{}a, format {} and language {}. New position is {}',
-                        first_reg.patron.patron_record_number, bib_record_number, bib_log.format,
-                        bib_log.language, first_reg.hold_queue_order
+                        'Moved .p{}a to bottom of queue for .b{}a, format {} and language {}',
+                        first_reg.patron.patron_record_number, bib_record_number, bib_log.format, bib_log.language
                     )
             else:
                 self._log_notice(
@@ -200,63 +456,219 @@ class Command(BaseCommand):
             self._log_error(
                 bib_log,
                 'An error occurred while processing .b{}a: {}',
-                bib.get('id', '?'), e
+                bib_record_number, e
             )
             self._log_exception_details(bib_log, sys.exc_info())
         finally:
-            bib_log.save()
-        return bib_log.bib_created_at
+            self.log_writer.add(bib_log)
+
+    def _retry_failed_holds(self, run_log):
+        #
+        # Holds that failed with a transient error in earlier runs are queued to be tried again. Try the ones that are
+        # due before looking for new bibs.
+        #
+        num_retried = 0
+        while not self.stopping.is_set() and not self._out_of_time():
+            num_jobs = self._place_queued_holds(self.RETRY_BATCH_SIZE)
+            num_retried += num_jobs
+            if num_jobs < self.RETRY_BATCH_SIZE:
+                break
+        if num_retried > 0:
+            self._log_info(run_log, 'Tried again to place {} holds that failed previously', num_retried)
+
+    def _place_holds(self, bib_record_number, registrations, bib_log):
+        holds = [
+            (bib_record_number, reg, self._new_hold_log(bib_log, reg))
+            for reg in registrations
+        ]
+        errors = self._request_and_log_holds([(x[0], x[1].id, x[2]) for x in holds])
+        #
+        # Queue the holds that failed with a transient error to be tried again by a later run.
+        #
+        num_queued = 0
+        for (bib_record_number, reg, hold_log), error in zip(holds, errors):
+            if error is None:
+                continue
+            job = HoldJob(
+                bib_log=bib_log,
+                bib_record_number=bib_record_number,
+                patron_record_number=hold_log.patron_record_number,
+                pickup_location=hold_log.pickup_location,
+                registration_id=reg.id
+            )
+            job.record_attempt(error)
+            if job.status == HoldJob.PENDING:
+                self.log_writer.add(job)
+                num_queued += 1
+        if num_queued > 0:
+            self._log_notice(
+                bib_log,
+                'Queued {} failed holds on .b{}a to be tried again',
+                num_queued, bib_record_number
+            )
 
-    def _place_hold(self, bib_record_number, registration, bib_log):
-        hold_log = HoldLog(
+    def _request_and_log_holds(self, holds):
+        #
+        # holds is a list of (bib record number, registration id, hold log), in the order the holds are to be
+        # requested in. Returns a list of the error for each hold, or None for each hold that was placed.
+        #
+        # Holds are requested in order. When they are requested concurrently, they can complete in a different order,
+        # so the order they completed in is recorded in each hold log.
+        #
+        # Each hold is first claimed in the hold ledger, and holds that have already been requested are skipped. A
+        # patron with more than one registration in the same queue has the same hold more than once in holds, and
+        # only the first of them is requested.
+        #
+        errors = [None] * len(holds)
+        claimed = HoldLedger.claim((x[2].patron_record_number, x[0]) for x in holds)
+        to_request = list()
+        for i, (bib_record_number, registration_id, hold_log) in enumerate(holds):
+            key = (hold_log.patron_record_number, bib_record_number)
+            if key in claimed:
+                claimed.remove(key)
+                to_request.append(i)
+            else:
+                self._log_notice(
+                    hold_log,
+                    'Skipping hold on .b{}a for .p{}a (registration id {}) because it has already been requested',
+                    bib_record_number, hold_log.patron_record_number, registration_id
+                )
+                self.log_writer.add(hold_log)
+        if self.event_loop is not None:
+            # sierra.async_api needs Python 3.5, so it is only imported when --async-holds is used.
+            from sierra.async_api import in_completion_order
+            completed = self.event_loop.run_until_complete(in_completion_order([
+                self.async_sierra_api.patrons_place_hold(
+                    holds[i][2].patron_record_number, 'b', holds[i][0], holds[i][2].pickup_location
+                )
+                for i in to_request
+            ]))
+            for completion_order, (j, task) in enumerate(completed, start=1):
+                i = to_request[j]
+                bib_record_number, registration_id, hold_log = holds[i]
+                hold_log.completion_order = completion_order
+                errors[i] = self._place_hold_and_log(bib_record_number, registration_id, hold_log, task.result)
+        elif self.hold_executor is None:
+            for completion_order, i in enumerate(to_request, start=1):
+                bib_record_number, registration_id, hold_log = holds[i]
+                hold_log.completion_order = completion_order
+                errors[i] = self._place_hold_and_log(
+                    bib_record_number, registration_id, hold_log,
+                    partial(self._request_hold, bib_record_number, hold_log)
+                )
+        else:
+            pending = dict()
+            for i in to_request:
+                bib_record_number, registration_id, hold_log = holds[i]
+                pending[self.hold_executor.submit(self._request_hold, bib_record_number, hold_log)] = i
+            for completion_order, future in enumerate(as_completed(pending), start=1):
+                i = pending[future]
+                bib_record_number, registration_id, hold_log = holds[i]
+                hold_log.completion_order = completion_order
+                errors[i] = self._place_hold_and_log(bib_record_number, registration_id, hold_log, future.result)
+        placed = set((holds[i][2].patron_record_number, holds[i][0]) for i in to_request if errors[i] is None)
+        failed = set((holds[i][2].patron_record_number, holds[i][0]) for i in to_request if errors[i] is not None)
+        HoldLedger.mark_placed(placed)
+        # A hold that was placed stays claimed, even if another request for it failed.
+        HoldLedger.release(failed - placed)
+        return errors
+
+    def _enqueue_holds(self, bib_record_number, registrations, bib_log):
+        for reg in registrations:
+            self.log_writer.add(HoldJob(
+                bib_log=bib_log,
+                bib_record_number=bib_record_number,
+                patron_record_number=reg.patron.patron_record_number,
+                pickup_location=reg.patron.pickup_location.code,
+                registration_id=reg.id
+            ))
+        self._log_info(
+            bib_log,
+            'Queued {} holds on .b{}a',
+            len(registrations), bib_record_number
+        )
+
+    def _place_queued_holds(self, limit):
+        #
+        # The claimed jobs stay locked, so that no other hold worker can claim them, until this transaction ends.
+        #
+        with transaction.atomic():
+            jobs = HoldJob.claim(limit)
+            errors = self._request_and_log_holds([
+                (
+                    job.bib_record_number,
+                    job.registration_id,
+                    HoldLog(
+                        bib_log_id=job.bib_log_id,
+                        patron_record_number=job.patron_record_number,
+                        pickup_location=job.pickup_location
+                    )
+                )
+                for job in jobs
+            ])
+            for job, error in zip(jobs, errors):
+                job.record_attempt(error)
+            for job in jobs:
+                job.save()
+            self.log_writer.flush()
+        return len(jobs)
+
+    def _new_hold_log(self, bib_log, registration):
+        return HoldLog(
             bib_log=bib_log,
             patron_record_number=registration.patron.patron_record_number,
             pickup_location=registration.patron.pickup_location.code
         )
+
+    def _request_hold(self, bib_record_number, hold_log):
+        # This can run on a worker thread, so it must not touch the database or write to stdout.
+        self.sierra_api.patrons_place_hold(
+            hold_log.patron_record_number,
+            'b',
+            bib_record_number,
+            hold_log.pickup_location
+        )
+
+    def _place_hold_and_log(self, bib_record_number, registration_id, hold_log, request_hold):
+        # Returns the error that prevented the hold from being placed, or None if the hold was placed.
+        error = None
         try:
-            self.sierra_api.patrons_place_hold(
-                hold_log.patron_record_number,
-                'b',
-                bib_record_number,
-                hold_log.pickup_location
-            )
+            request_hold()
         except SierraApiError as e:
+            error = e
             self._log_warning(
                 hold_log,
                 'Failed to place hold on .b{}a for .p{}a (registration id {}): {}',
-                bib_record_number, hold_log.patron_record_number, registration.id, e
+                bib_record_number, hold_log.patron_record_number, registration_id, e
             )
         except Exception as e:
+            error = e
             self._log_error(
                 hold_log,
                 'An error occurred while processing registration id {} for .b{}a: {}',
-                registration.id, bib_record_number, e
+                registration_id, bib_record_number, e
             )
             self._log_exception_details(hold_log, sys.exc_info())
         else:
             self._log_success(
                 hold_log,
                 'Successfully placed hold on .b{}a for .p{}a with pickup at {} (registration id {})',
-                bib_record_number, hold_log.patron_record_number, hold_log.pickup_location, registration.id
+                bib_record_number, hold_log.patron_record_number, hold_log.pickup_location, registration_id
             )
             hold_log.successful = True
         finally:
-            hold_log.save()
+            self.log_writer.add(hold_log)
+        return error
 
     def _get_bibs(self, *bib_ids):
-        result = list()
-        for bib_id in bib_ids:
-            result.append(self.sierra_api.bibs_get_for_id(bib_id, fields='id,author,materialType,lang,createdDate'))
-        return result
+        # None stands in for each bib id that has no bib.
+        return [
+            None if x is None else BibRecord.from_api_entry(x)
+            for x in self.sierra_api.bibs_get_many(bib_ids, fields=BIB_FIELDS)
+        ]
 
     def _get_new_bibs(self, created_date_from, created_date_to):
-        result = self.sierra_api.bibs_get(
-            created_date={'range_from': created_date_from, 'range_to': created_date_to},
-            fields='id,author,materialType,lang,createdDate',
-            deleted=False,
-            suppressed=False
-        )
-        return result['entries']
+        return self.bib_source.new_bibs(created_date_from, created_date_to)
 
     def _log_error(self, log, fmt, *args, **kwargs):
         log_note = fmt.format(*args, **kwargs)
@@ -0,0 +1,188 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+import multiprocessing
+
+import django
+from django.core.management.base import CommandError
+from django.db import connections, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import get_current_timezone, is_naive, localtime, make_aware
+
+from .autoholds import Command as AutoHoldsCommand
+from ...models import DiscoveryCheckpoint
+
+
+def _parse_when(value):
+    when = parse_datetime(value)
+    if when is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('{} is not a valid date or date/time'.format(value))
+        when = datetime.combine(date, time())
+    if is_naive(when):
+        when = make_aware(when, get_current_timezone())
+    return when
+
+
+def _process_window(args):
+    options, window_from, window_to = args
+    return Command()._process_window(options, window_from, window_to)
+
+
+class Command(AutoHoldsCommand):
+    """
+    Reprocesses a past date range in windows, spread over several worker processes.
+
+    Each window loads the hold queues as they are in the database when it starts, and only saves its rotations when
+    it ends. So windows that are processed at the same time, in different worker processes, all give the first hold
+    to the patrons at the front of the same hold queues, and only between them move those patrons to the end. With
+    one worker process, the windows are processed one after the other and the hold queues are kept as fairly as by
+    the autoholds command.
+    """
+
+    # Split the date range into this many windows per worker, so that a window with lots of bibs doesn't leave the
+    # other workers idle for long.
+    WINDOWS_PER_WORKER = 4
+
+    help = 'Reprocess the bibs created in a past date range, using several worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from', dest='created_from', required=True, type=_parse_when, metavar='DATE',
+            help='Reprocess the bibs created from this date or date/time'
+        )
+        parser.add_argument(
+            '--to', dest='created_to', required=True, type=_parse_when, metavar='DATE',
+            help='Reprocess the bibs created up until this date or date/time'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1, metavar='N',
+            help=(
+                'Reprocess the date range in N worker processes (default: 1). With more than one, windows processed '
+                'at the same time all give the first hold on a bib to the patron at the front of its hold queue, so '
+                'patrons are not rotated through the hold queues as fairly as by the autoholds command.'
+            )
+        )
+        parser.add_argument(
+            '--discovery', choices=['api', 'sql', 'sql-registered'], default='api',
+            help='How to discover the bibs, as for the autoholds command (default: api)'
+        )
+        parser.add_argument(
+            '--hold-workers', type=int, default=1, metavar='N',
+            help='Place up to N holds for a bib concurrently, in each worker process (default: 1)'
+        )
+        parser.add_argument(
+            '--log-all-bibs', action='store_true',
+            help='Log every bib, rather than only counting the ones that match no registration'
+        )
+        parser.add_argument(
+            '--max-run-log-notes', type=int, default=None, metavar='N',
+            help='Keep at most N notes in each run log, and only summarise the rest (default: keep them all)'
+        )
+
+    def handle(self, *args, **options):
+        created_from = options['created_from']
+        created_to = options['created_to']
+        if created_to <= created_from:
+            raise CommandError('--to must be after --from')
+        window_options = {
+            x: options[x] for x in ('discovery', 'hold_workers', 'log_all_bibs', 'max_run_log_notes')
+        }
+        windows = self._windows(created_from, created_to, options['workers'] * self.WINDOWS_PER_WORKER)
+        self.stdout.write('Reprocessing bibs created from {} to {} in {} windows, using {} worker processes'.format(
+            localtime(created_from), localtime(created_to), len(windows), options['workers']
+        ))
+        # The worker processes must not share this process's database connections.
+        for connection in connections.all():
+            connection.close()
+        with multiprocessing.Pool(options['workers'], initializer=django.setup) as pool:
+            results = list(pool.imap_unordered(
+                _process_window,
+                [(window_options, window_from, window_to) for window_from, window_to in windows]
+            ))
+        failed_windows = [x for x in results if not x['successful']]
+        for result in sorted(failed_windows, key=lambda x: x['window_from']):
+            self.stdout.write(
+                'The window from {} to {} did not complete successfully. See run log id {}.'.format(
+                    localtime(result['window_from']), localtime(result['window_to']), result['run_log_id']
+                ),
+                style_func=self.style.ERROR
+            )
+        if failed_windows:
+            raise CommandError('{} of {} windows failed. Run the backfill again for their date ranges.'.format(
+                len(failed_windows), len(results)
+            ))
+        self._merge_checkpoints(results)
+        self.stdout.write('Reprocessed all {} windows'.format(len(results)), style_func=self.style.SUCCESS)
+
+    @staticmethod
+    def _windows(created_from, created_to, num_windows):
+        #
+        # Sierra's created dates are only to the second, and the created date ranges include both ends. So each window
+        # ends the second before the next one starts, so that no bib is in two windows.
+        #
+        seconds = int((created_to - created_from).total_seconds())
+        num_windows = max(1, min(num_windows, seconds))
+        step = seconds / num_windows
+        starts = [created_from + timedelta(seconds=int(step * i)) for i in range(num_windows)]
+        ends = [x - timedelta(seconds=1) for x in starts[1:]] + [created_to]
+        return list(zip(starts, ends))
+
+    def _process_window(self, options, window_from, window_to):
+        # The window has its own checkpoint, which is only kept in memory.
+        self.log_all_bibs = options['log_all_bibs']
+        self.checkpoint = DiscoveryCheckpoint(
+            source=options['discovery'],
+            last_bib_record_number=0,
+            last_bib_created_at=window_from
+        )
+        self.save_checkpoint = False
+        if options['hold_workers'] > 1:
+            self.hold_executor = ThreadPoolExecutor(max_workers=options['hold_workers'])
+        try:
+            run_log, num_new_bibs = self._run(options, created_until=window_to)
+        finally:
+            if self.hold_executor is not None:
+                self.hold_executor.shutdown()
+        return {
+            'window_from': window_from,
+            'window_to': window_to,
+            'run_log_id': run_log.id,
+            'successful': run_log.successful,
+            'last_bib_record_number': self.checkpoint.last_bib_record_number,
+            'last_bib_created_at': self.checkpoint.last_bib_created_at,
+        }
+
+    def _merge_checkpoints(self, results):
+        #
+        # If the backfill got further than the regular autoholds runs, move their checkpoints forward, so they don't
+        # process the same bibs again.
+        #
+        last = max(results, key=lambda x: (x['last_bib_created_at'], x['last_bib_record_number']))
+        with transaction.atomic():
+            for checkpoint in DiscoveryCheckpoint.objects.select_for_update():
+                if last['last_bib_record_number'] > checkpoint.last_bib_record_number:
+                    checkpoint.last_bib_record_number = last['last_bib_record_number']
+                    checkpoint.last_bib_created_at = max(last['last_bib_created_at'], checkpoint.last_bib_created_at)
+                    checkpoint.save()
+                    self.stdout.write('Moved the {} checkpoint forward to .b{}a, created at {}'.format(
+                        checkpoint.source, checkpoint.last_bib_record_number, localtime(checkpoint.last_bib_created_at)
+                    ))
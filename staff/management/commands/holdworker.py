@@ -0,0 +1,69 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from concurrent.futures import ThreadPoolExecutor
+import signal
+
+from django.conf import settings
+
+from sierra.api import SierraApi_v2
+from .autoholds import Command as AutoHoldsCommand
+
+
+class Command(AutoHoldsCommand):
+
+    help = 'Place the holds queued by autoholds --enqueue-holds, and the failed holds queued to be tried again'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=50, metavar='N',
+            help='Claim up to N queued holds at a time (default: 50)'
+        )
+        parser.add_argument(
+            '--hold-workers', type=int, default=1, metavar='N',
+            help='Place up to N holds concurrently (default: 1, one hold at a time)'
+        )
+        parser.add_argument(
+            '--keep-running', action='store_true',
+            help='When there are no holds to place, wait for more rather than stopping'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=30, metavar='SECONDS',
+            help='With --keep-running, how long to wait before looking for more holds to place (default: 30)'
+        )
+
+    def handle(self, *args, **options):
+        def _stop(signum, frame):
+            self.stdout.write('Stopping after the current batch of holds', style_func=self.style.NOTICE)
+            self.stopping.set()
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+        self.sierra_api = SierraApi_v2.from_settings(settings.SIERRA_API)
+        if options['hold_workers'] > 1:
+            self.sierra_api.set_pool_size(options['hold_workers'])
+            self.hold_executor = ThreadPoolExecutor(max_workers=options['hold_workers'])
+        try:
+            while not self.stopping.is_set():
+                if self._place_queued_holds(options['batch_size']) == 0:
+                    if not options['keep_running']:
+                        break
+                    self._close_unusable_connections()
+                    self.stopping.wait(options['poll_interval'])
+        finally:
+            if self.hold_executor is not None:
+                self.hold_executor.shutdown()
@@ -0,0 +1,140 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from patron.models import Format, Language, PickupLocation, Registration
+from sierra.mockserver import MockCatalogue, MockSierra, MockSierraServer
+
+
+class Command(BaseCommand):
+
+    help = 'Run a mock Sierra API, with a synthetic catalogue, for load and regression testing AutoHolds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='The address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8800, help='The port to listen on (default: 8800)')
+        parser.add_argument(
+            '--num-bibs', type=int, default=100000, metavar='N',
+            help='Generate a catalogue of N bibs (default: 100000)'
+        )
+        parser.add_argument(
+            '--days', type=float, default=30,
+            help='Spread the bibs evenly over this many days up to now (default: 30)'
+        )
+        parser.add_argument(
+            '--num-authors', type=int, default=10000, metavar='N',
+            help='Pick the authors of the bibs from N synthetic authors (default: 10000)'
+        )
+        parser.add_argument(
+            '--registered-share', type=float, default=0.0, metavar='FRACTION',
+            help=(
+                "Give this fraction of the bibs the author, format and language of one of the registrations in "
+                "AutoHolds' database, so that holds get placed on them (default: 0)"
+            )
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Generate the catalogue, latencies and errors from this seed (default: 0)'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.0, metavar='SECONDS',
+            help='Wait this long before responding to each request (default: 0)'
+        )
+        parser.add_argument(
+            '--latency-jitter', type=float, default=0.0, metavar='SECONDS',
+            help='Wait up to this much longer again, at random (default: 0)'
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0, metavar='FRACTION',
+            help='Fail this fraction of requests with 503 Service Unavailable (default: 0)'
+        )
+        parser.add_argument(
+            '--hold-denied-rate', type=float, default=0.0, metavar='FRACTION',
+            help='Refuse this fraction of hold requests, as if the patron were blocked (default: 0)'
+        )
+        parser.add_argument(
+            '--max-page-size', type=int, default=2000, metavar='N',
+            help='Return at most N bibs per page, whatever limit is asked for (default: 2000)'
+        )
+        parser.add_argument('--client-key', default='key', help="The API key's client key (default: key)")
+        parser.add_argument('--client-secret', default='secret', help="The API key's client secret (default: secret)")
+        parser.add_argument('--verbose-requests', action='store_true', help='Log every request')
+
+    def handle(self, *args, **options):
+        #
+        # Use AutoHolds' own formats, languages and pickup locations, so that the bibs and patrons fit them.
+        #
+        format_codes = list(Format.objects.filter(active=True).values_list('code', flat=True)) or ['a']
+        language_codes = list(Language.objects.filter(active=True).values_list('code', flat=True)) or ['eng']
+        registered_keys = list()
+        if options['registered_share'] > 0:
+            registered_keys = list(
+                Registration.objects.filter(format__active=True, language__active=True)
+                .values_list('author__name', 'format__code', 'language__code')
+                .distinct()
+            )
+            if not registered_keys:
+                self.stdout.write(
+                    'There are no registrations, so no bibs will match one',
+                    style_func=self.style.WARNING
+                )
+        catalogue = MockCatalogue(
+            num_bibs=options['num_bibs'],
+            days=options['days'],
+            num_authors=options['num_authors'],
+            format_codes=format_codes,
+            language_codes=language_codes,
+            registered_keys=registered_keys,
+            registered_share=options['registered_share'],
+            seed=options['seed']
+        )
+        pickup_location = PickupLocation.default()
+        mock_sierra = MockSierra(
+            catalogue,
+            client_key=options['client_key'],
+            client_secret=options['client_secret'],
+            latency=options['latency'],
+            latency_jitter=options['latency_jitter'],
+            error_rate=options['error_rate'],
+            hold_denied_rate=options['hold_denied_rate'],
+            max_page_size=options['max_page_size'],
+            pickup_location=pickup_location.code if pickup_location is not None else 'a',
+            language_code=language_codes[0],
+            seed=options['seed']
+        )
+        server = MockSierraServer(mock_sierra, options['host'], options['port'], options['verbose_requests'])
+        self.stdout.write(
+            'Serving {} bibs created from {} to {}, at {}'.format(
+                len(catalogue), catalogue.created_from, catalogue.created_until, server.base_url
+            ),
+            style_func=self.style.SUCCESS
+        )
+        self.stdout.write(
+            'To use it, set base_url={!r}, client_key={!r} and client_secret={!r} in SIERRA_API'.format(
+                server.base_url, options['client_key'], options['client_secret']
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write('Served {} requests ({} failed as configured) and placed {} holds'.format(
+                mock_sierra.num_requests, mock_sierra.num_errors, len(mock_sierra.holds)
+            ))
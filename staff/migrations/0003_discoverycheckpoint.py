@@ -0,0 +1,54 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-05-09 01:47
+
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staff', '0002_holdlog_completion_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscoveryCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(editable=False, max_length=20, unique=True)),
+                ('last_bib_record_number', models.IntegerField(default=0, editable=False)),
+                ('last_bib_created_at', models.DateTimeField(editable=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='biblog',
+            name='bib_created_at',
+            field=models.DateTimeField(db_index=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='runlog',
+            name='ended_at',
+            field=models.DateTimeField(db_index=True, editable=False, null=True),
+        ),
+    ]
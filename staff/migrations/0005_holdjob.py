@@ -0,0 +1,60 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-06-06 05:20
+
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staff', '0004_runlog_num_bibs_unmatched'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HoldJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bib_record_number', models.IntegerField(editable=False)),
+                ('patron_record_number', models.IntegerField(editable=False)),
+                ('pickup_location', models.CharField(blank=True, editable=False, max_length=5)),
+                ('registration_id', models.IntegerField(editable=False, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', editable=False, max_length=10)),
+                ('attempts', models.IntegerField(default=0, editable=False)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('last_error', models.TextField(blank=True, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bib_log', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='hold_jobs', to='staff.BibLog')),
+            ],
+        ),
+        #
+        # Hold workers only ever look for pending jobs that are due, so only those need to be indexed.
+        #
+        migrations.RunSQL(
+            "CREATE INDEX staff_holdjob_pending ON staff_holdjob (next_attempt_at, id) WHERE status = 'pending'",
+            'DROP INDEX staff_holdjob_pending'
+        ),
+    ]
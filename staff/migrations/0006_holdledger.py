@@ -0,0 +1,59 @@
+# Copyright 2016 Susan Bennett, David Mitchell, Jim Nicholls
+#
+# This file is part of AutoHolds.
+#
+# AutoHolds is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# AutoHolds is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
+#
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2016-06-13 02:41
+
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staff', '0005_holdjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HoldLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patron_record_number', models.IntegerField(editable=False)),
+                ('bib_record_number', models.IntegerField(editable=False)),
+                ('placed', models.BooleanField(default=False, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='holdledger',
+            unique_together=set([('patron_record_number', 'bib_record_number')]),
+        ),
+        #
+        # Every hold that has already been placed successfully goes into the ledger, so that it's never placed again.
+        #
+        migrations.RunSQL(
+            'INSERT INTO staff_holdledger (patron_record_number, bib_record_number, placed, created_at) '
+            'SELECT h.patron_record_number, b.bib_record_number, TRUE, MIN(h.log_created_at) '
+            'FROM staff_holdlog AS h JOIN staff_biblog AS b ON b.id = h.bib_log_id '
+            'WHERE h.successful '
+            'GROUP BY h.patron_record_number, b.bib_record_number',
+            migrations.RunSQL.noop
+        ),
+    ]
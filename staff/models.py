@@ -16,7 +16,12 @@
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.db import models
+from datetime import timedelta
+
+from django.db import connection, models, transaction
+from django.utils.timezone import now
+
+from sierra.api import SierraApiError
 
 
 class Log(models.Model):
@@ -24,11 +29,39 @@ class Log(models.Model):
     log_updated_at = models.DateTimeField(auto_now=True, editable=False)
     log_notes = models.TextField(editable=False)
 
+    # If set, at most this many log notes are kept. Any further log notes are only counted, by their level, and a
+    # summary of them is added to the end of the log notes.
+    max_log_notes = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._log_note_list = None
+        self._omitted_log_note_counts = dict()
+
     def append_log_note(self, log_note):
-        if self.log_notes:
-            self.log_notes = self.log_notes + '\n' + log_note
+        # The log notes are collected in a list, and are only joined into log_notes when the log is saved.
+        if self._log_note_list is None:
+            self._log_note_list = [self.log_notes] if self.log_notes else list()
+        if self.max_log_notes is not None and len(self._log_note_list) >= self.max_log_notes:
+            level = log_note[1:log_note.find(']')] if log_note.startswith('[') else 'DETAILS'
+            self._omitted_log_note_counts[level] = self._omitted_log_note_counts.get(level, 0) + 1
         else:
-            self.log_notes = log_note
+            self._log_note_list.append(log_note)
+
+    def join_log_notes(self):
+        if self._log_note_list is None:
+            return
+        log_notes = list(self._log_note_list)
+        if self._omitted_log_note_counts:
+            log_notes.append('[NOTICE] {} further log notes were omitted ({})'.format(
+                sum(self._omitted_log_note_counts.values()),
+                ', '.join('{} {}'.format(n, level) for level, n in sorted(self._omitted_log_note_counts.items()))
+            ))
+        self.log_notes = '\n'.join(log_notes)
+
+    def save(self, *args, **kwargs):
+        self.join_log_notes()
+        super().save(*args, **kwargs)
 
     class Meta:
         abstract = True
@@ -36,13 +69,18 @@ class Log(models.Model):
 
 class RunLog(Log):
     started_at = models.DateTimeField(editable=False)
-    ended_at = models.DateTimeField(null=True, editable=False)
+    ended_at = models.DateTimeField(null=True, editable=False, db_index=True)
     successful = models.BooleanField(default=False, editable=False)
     num_bibs_found = models.IntegerField(default=0, editable=False)
+    num_bibs_unmatched = models.IntegerField(default=0, editable=False)
     first_bib_record_number = models.IntegerField(null=True, editable=False)
     first_bib_created_at = models.DateTimeField(null=True, editable=False)
     last_bib_record_number = models.IntegerField(null=True, editable=False)
     last_bib_created_at = models.DateTimeField(null=True, editable=False)
+    time_budget = models.FloatField(null=True, editable=False)
+    time_budget_exhausted = models.BooleanField(default=False, editable=False)
+    num_batches = models.IntegerField(default=0, editable=False)
+    bibs_per_second = models.FloatField(null=True, editable=False)
 
     class Meta(Log.Meta):
         pass
@@ -51,7 +89,7 @@ class RunLog(Log):
 class BibLog(Log):
     run_log = models.ForeignKey(RunLog, models.CASCADE, editable=False, related_name='bibs_found')
     bib_record_number = models.IntegerField(editable=False)
-    bib_created_at = models.DateTimeField(editable=False)
+    bib_created_at = models.DateTimeField(editable=False, db_index=True)
     author = models.CharField(blank=True, max_length=255, editable=False)
     format = models.CharField(blank=True, max_length=1, editable=False)
     language = models.CharField(blank=True, max_length=3, editable=False)
@@ -66,6 +104,260 @@ class HoldLog(Log):
     patron_record_number = models.IntegerField(editable=False)
     pickup_location = models.CharField(blank=True, max_length=5, editable=False)
     successful = models.BooleanField(default=False, editable=False)
+    completion_order = models.IntegerField(null=True, editable=False)
 
     class Meta(Log.Meta):
         pass
+
+
+class DiscoveryCheckpoint(models.Model):
+    """Where the autoholds command is up to in discovering new bibs, for each discovery source."""
+    source = models.CharField(max_length=20, unique=True, editable=False)
+    last_bib_record_number = models.IntegerField(default=0, editable=False)
+    last_bib_created_at = models.DateTimeField(editable=False)
+    updated_at = models.DateTimeField(auto_now=True, editable=False)
+
+    def __str__(self):
+        return '{}: .b{}a created at {}'.format(self.source, self.last_bib_record_number, self.last_bib_created_at)
+
+
+class HoldJob(models.Model):
+    """
+    A hold that discovery has found should be placed, waiting for a hold worker to place it.
+
+    Hold workers claim pending jobs whose next attempt is due with SELECT ... FOR UPDATE SKIP LOCKED, so any number
+    of them, in any number of processes, can work through the jobs without claiming the same job twice.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # A job that fails with a transient error, such as Sierra being unavailable, is tried again after RETRY_DELAY
+    # seconds, doubling after each attempt, until it has been attempted MAXIMUM_ATTEMPTS times. A job that fails with a
+    # permanent error, such as the patron being blocked, is not tried again.
+    MAXIMUM_ATTEMPTS = 8
+    RETRY_DELAY = 60
+
+    CLAIM_SQL = (
+        'SELECT * FROM staff_holdjob '
+        'WHERE status = %s AND next_attempt_at <= %s '
+        'ORDER BY next_attempt_at, id '
+        'LIMIT %s '
+        'FOR UPDATE SKIP LOCKED'
+    )
+
+    bib_log = models.ForeignKey(BibLog, models.CASCADE, editable=False, related_name='hold_jobs')
+    bib_record_number = models.IntegerField(editable=False)
+    patron_record_number = models.IntegerField(editable=False)
+    pickup_location = models.CharField(blank=True, max_length=5, editable=False)
+    registration_id = models.IntegerField(null=True, editable=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, editable=False)
+    attempts = models.IntegerField(default=0, editable=False)
+    next_attempt_at = models.DateTimeField(default=now, editable=False)
+    last_error = models.TextField(blank=True, editable=False)
+    error_code = models.IntegerField(null=True, editable=False)
+    error_specific_code = models.IntegerField(null=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, editable=False)
+
+    @staticmethod
+    def claim(limit):
+        """Claim up to limit jobs that are due. Must be called inside a transaction, which holds the claim."""
+        return list(HoldJob.objects.raw(HoldJob.CLAIM_SQL, (HoldJob.PENDING, now(), limit)))
+
+    def record_attempt(self, error=None):
+        self.attempts += 1
+        if error is None:
+            self.status = self.DONE
+            self.last_error = ''
+        else:
+            self.last_error = str(error)
+            if isinstance(error, SierraApiError):
+                self.error_code = error.code
+                self.error_specific_code = error.specific_code
+                is_transient = error.is_transient
+            else:
+                self.error_code = None
+                self.error_specific_code = None
+                is_transient = True
+            if not is_transient or self.attempts >= self.MAXIMUM_ATTEMPTS:
+                self.status = self.FAILED
+            else:
+                self.next_attempt_at = now() + timedelta(seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1))
+
+    def __str__(self):
+        return 'Hold on .b{}a for .p{}a ({})'.format(self.bib_record_number, self.patron_record_number, self.status)
+
+
+class HoldLedger(models.Model):
+    """
+    A record of every hold that has been requested, so that the same hold is never requested twice.
+
+    A hold is claimed in the ledger before it is requested. Claiming a hold that is already in the ledger does
+    nothing, so whoever claims it first is the only one to request it. If the request fails, the claim is released so
+    that it can be tried again. If the request succeeds, the claim is marked as placed. A claim that was never marked
+    placed or released belongs to a request that was interrupted, and the hold may or may not have been placed.
+    """
+    patron_record_number = models.IntegerField(editable=False)
+    bib_record_number = models.IntegerField(editable=False)
+    placed = models.BooleanField(default=False, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        unique_together = ('patron_record_number', 'bib_record_number')
+
+    CLAIM_SQL = (
+        'INSERT INTO staff_holdledger (patron_record_number, bib_record_number, placed, created_at) '
+        'SELECT t.patron_record_number, t.bib_record_number, FALSE, now() '
+        'FROM unnest(%s::integer[], %s::integer[]) AS t (patron_record_number, bib_record_number) '
+        'ON CONFLICT (patron_record_number, bib_record_number) DO NOTHING '
+        'RETURNING patron_record_number, bib_record_number'
+    )
+
+    MARK_PLACED_SQL = (
+        'UPDATE staff_holdledger AS l SET placed = TRUE '
+        'FROM unnest(%s::integer[], %s::integer[]) AS t (patron_record_number, bib_record_number) '
+        'WHERE l.patron_record_number = t.patron_record_number AND l.bib_record_number = t.bib_record_number'
+    )
+
+    RELEASE_SQL = (
+        'DELETE FROM staff_holdledger AS l '
+        'USING unnest(%s::integer[], %s::integer[]) AS t (patron_record_number, bib_record_number) '
+        'WHERE l.patron_record_number = t.patron_record_number AND l.bib_record_number = t.bib_record_number'
+    )
+
+    @staticmethod
+    def claim(holds):
+        """
+        Claim the (patron record number, bib record number) holds that are not already in the ledger, and return the
+        set of the ones that were claimed.
+        """
+        return set(HoldLedger._execute(HoldLedger.CLAIM_SQL, holds, fetch=True))
+
+    @staticmethod
+    def mark_placed(holds):
+        HoldLedger._execute(HoldLedger.MARK_PLACED_SQL, holds)
+
+    @staticmethod
+    def release(holds):
+        HoldLedger._execute(HoldLedger.RELEASE_SQL, holds)
+
+    @staticmethod
+    def _execute(sql, holds, fetch=False):
+        holds = list(holds)
+        if not holds:
+            return list()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [list(x) for x in zip(*holds)])
+            return [tuple(x) for x in cursor.fetchall()] if fetch else list()
+
+    def __str__(self):
+        return 'Hold on .b{}a for .p{}a{}'.format(
+            self.bib_record_number, self.patron_record_number, '' if self.placed else ' (not known to be placed)'
+        )
+
+
+class LogWriter:
+    """
+    Buffers new bib logs, and the new hold logs and hold jobs that belong to them, in memory and writes them with
+    bulk_create, in a single transaction.
+
+    They are written whenever flush() is called and, with auto_flush, whenever flush_every of them are buffered.
+    Without auto_flush, the owner checks is_full() and flushes at a point where it can write its own state along with
+    the logs. A hold log or hold job is held back until its bib log is either already saved or being written in the
+    same flush.
+    """
+
+    def __init__(self, flush_every=500, auto_flush=True):
+        self.flush_every = flush_every
+        self.auto_flush = auto_flush
+        self._bib_logs = list()
+        # The hold logs and hold jobs are kept as (obj, bib log), where the bib log is the one obj was given before the
+        # bib log was saved, or None if obj was given a saved bib log. The writer keeps hold of the bib log itself,
+        # because obj forgets it when its bib_log_id changes.
+        self._bib_log_children = {HoldLog: list(), HoldJob: list()}
+
+    def __len__(self):
+        return len(self._bib_logs) + sum(len(x) for x in self._bib_log_children.values())
+
+    def add(self, obj):
+        if isinstance(obj, BibLog):
+            self._bib_logs.append(obj)
+        elif type(obj) in self._bib_log_children:
+            self._bib_log_children[type(obj)].append((obj, obj.bib_log if obj.bib_log_id is None else None))
+        else:
+            raise TypeError('LogWriter can only write bib logs, hold logs and hold jobs, not {!r}'.format(obj))
+        if self.auto_flush and self.is_full():
+            self.flush()
+
+    def is_full(self):
+        return len(self) >= self.flush_every
+
+    def flush(self):
+        bib_logs = self._bib_logs
+        bib_logs_being_written = set(id(x) for x in bib_logs)
+        children = dict()
+        held_back_children = dict()
+        for model, pairs in self._bib_log_children.items():
+            children[model] = list()
+            held_back_children[model] = list()
+            for obj, bib_log in pairs:
+                if bib_log is None or bib_log.pk is not None or id(bib_log) in bib_logs_being_written:
+                    children[model].append((obj, bib_log))
+                else:
+                    held_back_children[model].append((obj, bib_log))
+        if bib_logs or any(children.values()):
+            try:
+                with transaction.atomic():
+                    self._bulk_create(BibLog, bib_logs)
+                    for pairs in children.values():
+                        for obj, bib_log in pairs:
+                            if bib_log is not None:
+                                # Re-assign the bib log so that obj picks up the bib log's new primary key.
+                                obj.bib_log = bib_log
+                    for model, pairs in children.items():
+                        self._bulk_create(model, [obj for obj, bib_log in pairs])
+            except Exception:
+                #
+                # The primary keys given out in this flush were rolled back along with it. Forget them, so that the
+                # same objects are given new ones when they are flushed again. The hold logs and hold jobs are given
+                # their bib logs' new ones then too.
+                #
+                for obj in bib_logs:
+                    obj.pk = None
+                for pairs in children.values():
+                    for obj, bib_log in pairs:
+                        obj.pk = None
+                raise
+        self._bib_logs = list()
+        self._bib_log_children = held_back_children
+
+    @staticmethod
+    def _bulk_create(model, objs):
+        #
+        # bulk_create doesn't set the primary keys of the objects it creates, and the primary keys of the bib logs are
+        # needed for their hold logs and hold jobs. So on PostgreSQL, reserve the primary keys from the table's
+        # sequence up-front. Elsewhere, fall back to saving each object individually.
+        #
+        if not objs:
+            return
+        if connection.vendor != 'postgresql':
+            for obj in objs:
+                obj.save()
+            return
+        for obj in objs:
+            if isinstance(obj, Log):
+                obj.join_log_notes()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                (model._meta.db_table, model._meta.pk.column, len(objs))
+            )
+            for obj, (pk,) in zip(objs, cursor.fetchall()):
+                obj.pk = pk
+        model.objects.bulk_create(objs)
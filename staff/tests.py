@@ -15,6 +15,303 @@
 # You should have received a copy of the GNU General Public License
 # along with AutoHolds.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+import threading
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now
+
+from patron.models import Author, Format, Language, Patron, PickupLocation, Registration, normalize_author
+from sierra.api import SierraApiError
+from sierra.mockserver import MockCatalogue, MockSierra, MockSierraServer
+from .models import BibLog, DiscoveryCheckpoint, HoldJob, HoldLedger, HoldLog, LogWriter, RunLog
+
+
+class LogWriterTests(TestCase):
+
+    def setUp(self):
+        self.run_log = RunLog.objects.create(started_at=now())
+
+    def _bib_log(self, bib_record_number):
+        return BibLog(run_log=self.run_log, bib_record_number=bib_record_number, bib_created_at=now())
+
+    def test_flush_writes_hold_logs_with_their_bib_logs(self):
+        log_writer = LogWriter()
+        bib_log = self._bib_log(1000001)
+        log_writer.add(bib_log)
+        log_writer.add(HoldLog(bib_log=bib_log, patron_record_number=2000001))
+        log_writer.flush()
+        self.assertEqual(len(log_writer), 0)
+        hold_log = HoldLog.objects.get()
+        self.assertEqual(hold_log.bib_log_id, BibLog.objects.get().id)
+
+    def test_failed_flush_can_be_retried(self):
+        log_writer = LogWriter()
+        bib_log = self._bib_log(1000001)
+        hold_log = HoldLog(bib_log=bib_log, patron_record_number=None)
+        log_writer.add(bib_log)
+        log_writer.add(hold_log)
+        with self.assertRaises(IntegrityError):
+            log_writer.flush()
+        self.assertEqual(len(log_writer), 2)
+        self.assertFalse(BibLog.objects.exists())
+        hold_log.patron_record_number = 2000001
+        log_writer.flush()
+        self.assertEqual(len(log_writer), 0)
+        saved_bib_log = BibLog.objects.get()
+        self.assertEqual(saved_bib_log.id, bib_log.id)
+        self.assertEqual(HoldLog.objects.get().bib_log_id, saved_bib_log.id)
+
+    def test_hold_log_made_before_its_bib_log_was_written_is_written_later(self):
+        log_writer = LogWriter()
+        bib_log = self._bib_log(1000001)
+        hold_log = HoldLog(bib_log=bib_log, patron_record_number=2000001)
+        log_writer.add(bib_log)
+        log_writer.flush()
+        log_writer.add(hold_log)
+        log_writer.flush()
+        self.assertEqual(len(log_writer), 0)
+        self.assertEqual(HoldLog.objects.get().bib_log_id, BibLog.objects.get().id)
+
+
+class HoldJobTests(SimpleTestCase):
+
+    def setUp(self):
+        self.job = HoldJob(bib_record_number=1000001, patron_record_number=2000001, pickup_location='a')
+
+    def test_a_successful_attempt_is_done(self):
+        self.job.record_attempt()
+        self.assertEqual(self.job.attempts, 1)
+        self.assertEqual(self.job.status, HoldJob.DONE)
+
+    @mock.patch('staff.models.now')
+    def test_a_transient_error_is_tried_again_later_and_later(self, mock_now):
+        mock_now.return_value = started_at = now()
+        error = SierraApiError(httpStatus=503, code=109, specificCode=0, name='Service Unavailable')
+        self.job.record_attempt(error)
+        self.assertEqual(self.job.status, HoldJob.PENDING)
+        self.assertEqual((self.job.error_code, self.job.error_specific_code), (109, 0))
+        self.assertEqual(self.job.next_attempt_at, started_at + timedelta(seconds=HoldJob.RETRY_DELAY))
+        self.job.record_attempt(error)
+        self.assertEqual(self.job.status, HoldJob.PENDING)
+        self.assertEqual(self.job.next_attempt_at, started_at + timedelta(seconds=2 * HoldJob.RETRY_DELAY))
+
+    def test_an_error_that_is_not_from_sierra_is_transient(self):
+        self.job.record_attempt(OSError('Connection reset by peer'))
+        self.assertEqual(self.job.status, HoldJob.PENDING)
+        self.assertIsNone(self.job.error_code)
+
+    def test_an_xcirc_error_is_not_tried_again(self):
+        self.job.record_attempt(SierraApiError(httpStatus=500, code=132, specificCode=2, name='XCirc error'))
+        self.assertEqual(self.job.status, HoldJob.FAILED)
+        self.assertEqual((self.job.error_code, self.job.error_specific_code), (132, 2))
+
+    def test_a_job_fails_after_the_maximum_number_of_attempts(self):
+        self.job.attempts = HoldJob.MAXIMUM_ATTEMPTS - 1
+        self.job.record_attempt(SierraApiError(httpStatus=503, code=109, specificCode=0))
+        self.assertEqual(self.job.attempts, HoldJob.MAXIMUM_ATTEMPTS)
+        self.assertEqual(self.job.status, HoldJob.FAILED)
+
+
+class _HoldsUnavailableMockSierra(MockSierra):
+    # A mock Sierra API that, while holds_unavailable is set, fails every hold request as if Sierra were unavailable.
+
+    holds_unavailable = False
+
+    def handle(self, method, path, params, authorization, body):
+        if self.holds_unavailable and method == 'POST' and path.endswith('/holds/requests'):
+            return self._error(503, 109, 0, 'Service Unavailable')
+        return super().handle(method, path, params, authorization, body)
+
+
+class AutoholdsCommandTests(TransactionTestCase):
+    """
+    Runs the autoholds command against a mock Sierra API, served over HTTP on a thread.
+
+    The hold queue orders are only updated in memory once the transaction that saved them commits, so these tests
+    run outside of a test transaction, like the command does.
+    """
+
+    AUTHOR_NAME = 'Smith, John'
+    NUM_BIBS = 300
+
+    def setUp(self):
+        self.format = Format.objects.create(code='a', value='Book')
+        self.language = Language.objects.create(code='eng', name='English')
+        self.pickup_location = PickupLocation.objects.create(code='a', name='Main library')
+        author = Author.objects.create(name=self.AUTHOR_NAME, friendly_name='John Smith')
+        self.registrations = [
+            Registration.objects.create(
+                patron=Patron.objects.create(
+                    patron_record_number=2000001 + i,
+                    pickup_location=self.pickup_location,
+                    default_format=self.format,
+                    default_language=self.language
+                ),
+                author=author,
+                format=self.format,
+                language=self.language,
+                hold_queue_order=i + 1
+            )
+            for i in range(3)
+        ]
+        self.catalogue = MockCatalogue(
+            num_bibs=self.NUM_BIBS,
+            days=1,
+            created_until=now() - timedelta(minutes=1),
+            registered_keys=[(self.AUTHOR_NAME, 'a', 'eng')],
+            registered_share=0.2
+        )
+        # Resume from just before the first bib in the catalogue.
+        DiscoveryCheckpoint.objects.create(
+            source='api',
+            last_bib_record_number=0,
+            last_bib_created_at=self.catalogue.created_from - timedelta(seconds=1)
+        )
+        key = normalize_author(self.AUTHOR_NAME)
+        self.matching_bib_record_numbers = [
+            int(bib['id'])
+            for bib in (self.catalogue.bib(i) for i in range(self.NUM_BIBS))
+            if normalize_author(bib['author']) == key
+        ]
+
+    def _serve(self, mock_sierra):
+        server = MockSierraServer(mock_sierra, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return SimpleNamespace(
+            base_url=server.base_url, client_key=mock_sierra.client_key, client_secret=mock_sierra.client_secret,
+            max_retries=10, backoff_factor=0
+        )
+
+    def _autoholds(self, sierra_api_settings, **options):
+        with override_settings(SIERRA_API=sierra_api_settings):
+            call_command('autoholds', stdout=StringIO(), **options)
+        return RunLog.objects.latest('id')
+
+    def _expected_holds(self):
+        return {
+            (reg.patron.patron_record_number, 'b', bib_record_number)
+            for bib_record_number in self.matching_bib_record_numbers
+            for reg in self.registrations
+        }
+
+    def test_places_holds_on_matching_bibs_despite_errors(self):
+        mock_sierra = MockSierra(self.catalogue, error_rate=0.2)
+        sierra_api_settings = self._serve(mock_sierra)
+        run_log = self._autoholds(sierra_api_settings)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        #
+        # Batches resume from the creation time of the last bib seen, which is included, so the batch that finds no
+        # new bibs finds the last bib again, and skips it.
+        #
+        self.assertEqual(run_log.num_bibs_found, self.NUM_BIBS + 1)
+        # Some of the requests failed with 503, and were retried until they succeeded.
+        self.assertGreater(mock_sierra.num_errors, 0)
+        self.assertEqual(set(mock_sierra.holds), self._expected_holds())
+        self.assertFalse(HoldJob.objects.exists())
+        #
+        # Every matching bib, and every hold on it, is logged, and every hold is in the ledger as placed.
+        #
+        self.assertEqual(
+            sorted(BibLog.objects.values_list('bib_record_number', flat=True)),
+            self.matching_bib_record_numbers
+        )
+        self.assertEqual(HoldLog.objects.filter(successful=True).count(), len(self._expected_holds()))
+        self.assertFalse(HoldLog.objects.filter(successful=False).exists())
+        self.assertEqual(
+            set(HoldLedger.objects.filter(placed=True).values_list('patron_record_number', 'bib_record_number')),
+            {(x[0], x[2]) for x in self._expected_holds()}
+        )
+        self.assertFalse(HoldLedger.objects.filter(placed=False).exists())
+        #
+        # The checkpoint has moved to the last bib, and each matching bib moved the front registration to the back.
+        #
+        checkpoint = DiscoveryCheckpoint.objects.get(source='api')
+        self.assertEqual(checkpoint.last_bib_record_number, self.catalogue.first_bib_record_number + self.NUM_BIBS - 1)
+        self.assertEqual(checkpoint.last_bib_created_at, self.catalogue.created_at(self.NUM_BIBS - 1))
+        num_moves = len(self.matching_bib_record_numbers) % len(self.registrations)
+        self.assertEqual(
+            list(Registration.objects.order_by('hold_queue_order', 'id').values_list('id', flat=True)),
+            [x.id for x in self.registrations[num_moves:] + self.registrations[:num_moves]]
+        )
+        #
+        # The next run resumes from the checkpoint, so it only finds the last bib again, and places no more holds.
+        #
+        run_log = self._autoholds(sierra_api_settings)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        self.assertEqual(run_log.num_bibs_found, 1)
+        self.assertEqual(
+            DiscoveryCheckpoint.objects.get(source='api').last_bib_record_number, checkpoint.last_bib_record_number
+        )
+        self.assertEqual(set(mock_sierra.holds), self._expected_holds())
+        self.assertEqual(HoldLog.objects.count(), len(self._expected_holds()))
+
+    def test_a_patron_registered_twice_in_a_queue_gets_one_hold_per_bib(self):
+        # Both authors' names have the same key, so their registrations share a queue.
+        other_author = Author.objects.create(name='SMITH, JOHN, 1950-', friendly_name='John Smith')
+        patron = self.registrations[0].patron
+        Registration.objects.create(
+            patron=patron, author=other_author, format=self.format, language=self.language, hold_queue_order=1
+        )
+        mock_sierra = MockSierra(self.catalogue)
+        run_log = self._autoholds(self._serve(mock_sierra))
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        num_holds = len(self._expected_holds())
+        self.assertEqual(set(mock_sierra.holds), self._expected_holds())
+        self.assertEqual(HoldLog.objects.filter(successful=True).count(), num_holds)
+        # The second hold for the patron is skipped, rather than refused by Sierra, and doesn't lose the ledger row.
+        self.assertEqual(
+            HoldLog.objects.filter(successful=False, patron_record_number=patron.patron_record_number).count(),
+            len(self.matching_bib_record_numbers)
+        )
+        self.assertEqual(HoldLedger.objects.filter(placed=True).count(), num_holds)
+        self.assertFalse(HoldJob.objects.exists())
+
+    def test_the_time_budget_is_only_exhausted_when_new_bibs_are_left(self):
+        sierra_api_settings = self._serve(MockSierra(self.catalogue))
+        checkpoint = DiscoveryCheckpoint.objects.get(source='api')
+        run_log = self._autoholds(sierra_api_settings, time_budget=0)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        self.assertTrue(run_log.time_budget_exhausted)
+        self.assertFalse(BibLog.objects.exists())
+        self.assertEqual(
+            DiscoveryCheckpoint.objects.get(source='api').last_bib_record_number, checkpoint.last_bib_record_number
+        )
+        # A run that gets through every new bib within its budget hasn't exhausted it, however long it took.
+        run_log = self._autoholds(sierra_api_settings, time_budget=3600)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        self.assertFalse(run_log.time_budget_exhausted)
+        self.assertEqual(BibLog.objects.count(), len(self.matching_bib_record_numbers))
+
+    def test_holds_that_failed_with_a_transient_error_are_placed_by_a_later_run(self):
+        mock_sierra = _HoldsUnavailableMockSierra(self.catalogue)
+        mock_sierra.holds_unavailable = True
+        sierra_api_settings = self._serve(mock_sierra)
+        sierra_api_settings.max_retries = 0
+        run_log = self._autoholds(sierra_api_settings)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        num_holds = len(self._expected_holds())
+        self.assertEqual(mock_sierra.holds, dict())
+        self.assertEqual(HoldLog.objects.filter(successful=False).count(), num_holds)
+        self.assertEqual(HoldJob.objects.filter(status=HoldJob.PENDING, attempts=1).count(), num_holds)
+        # The failed holds' claims were released, so that they can be requested again.
+        self.assertFalse(HoldLedger.objects.exists())
+        #
+        # Once Sierra is back, and the jobs are due, the next run places them before looking for new bibs.
+        #
+        mock_sierra.holds_unavailable = False
+        HoldJob.objects.update(next_attempt_at=now())
+        run_log = self._autoholds(sierra_api_settings)
+        self.assertTrue(run_log.successful, run_log.log_notes)
+        self.assertEqual(set(mock_sierra.holds), self._expected_holds())
+        self.assertEqual(HoldJob.objects.filter(status=HoldJob.DONE, attempts=2).count(), num_holds)
+        self.assertEqual(HoldLog.objects.filter(successful=True).count(), num_holds)
+        self.assertEqual(HoldLedger.objects.filter(placed=True).count(), num_holds)